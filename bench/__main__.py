@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import math
+import sys
+import tempfile
+from .fakes import FakeDiscord
+from .scenarios import Bench, SCENARIOS
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def report(results):
+    lines = [f"{'scenario':<18}{'action':<8}{'count':>7}{'p50 ms':>9}{'p99 ms':>9}{'sql/op':>9}{'api/op':>9}{'429s':>7}"]
+    for result in results:
+        count = len(result.latencies) or 1
+        lines.append(
+            f'{result.scenario:<18}{result.action:<8}{len(result.latencies):>7}'
+            f'{percentile(result.latencies, 50) * 1000:>9.1f}{percentile(result.latencies, 99) * 1000:>9.1f}'
+            f'{result.sql / count:>9.2f}{sum(result.calls.values()) / count:>9.2f}{result.rate_limited:>7}'
+        )
+        for route, calls in sorted(result.calls.items(), key=lambda item: -item[1]):
+            lines.append(f'    {route:<52}{calls / count:>9.2f}')
+    return '\n'.join(lines)
+
+def parse_rate_limit(value):
+    limit, _, window = value.partition('/')
+    return int(limit), float(window or 1)
+
+async def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenarios or list(SCENARIOS):
+            limit, window = args.rate_limit
+            api = FakeDiscord(args.latency, args.jitter, limit, window, args.seed)
+            bench = Bench(api, workdir, name, args.seed)
+            await bench.start()
+            try:
+                print(f'Running {name}...', file=sys.stderr)
+                await SCENARIOS[name](bench, users=args.users, seconds=args.seconds, testers=args.testers, rounds=args.rounds, rows=args.rows)
+            finally:
+                await bench.stop()
+            results.extend(bench.results)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Run the bot against an in-process fake of Discord and report latency, SQL and API usage per action.')
+    parser.add_argument('scenarios', nargs='*', help=f'Scenarios to run, from {", ".join(SCENARIOS)}; all by default')
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated API round trip in seconds')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Fraction the round trip varies by')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, default='50/1', help='Calls per seconds allowed per route and channel/guild; 50/1 is Discord\'s global limit, 5/5 its per-channel message limit, 0 disables')
+    parser.add_argument('--users', type=int, default=500, help='Users clicking in join_burst and large_user_info')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Window the users click within')
+    parser.add_argument('--testers', type=int, default=5, help='Testers in concurrent_next')
+    parser.add_argument('--rounds', type=int, default=20, help='/next calls per tester in concurrent_next')
+    parser.add_argument('--rows', type=int, default=100_000, help='user_info rows in large_user_info')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Also write the report to this file')
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenario(s): {", ".join(unknown)}')
+    text = report(asyncio.run(run(args)))
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import asyncio
+import discord
+import itertools
+import random
+import time
+from collections import Counter, deque
+
+ids = itertools.count(10_000)
+
+class FakeDiscord:
+    # Stands in for Discord's REST API. Every call sleeps for a simulated
+    # round trip and is counted by route. Buckets allow `limit` calls per
+    # `window` seconds per route and major id (channel, guild or webhook);
+    # a call over the limit waits for a free slot the way discord.py does
+    # after a 429, and the wait is counted. Renaming a channel has its own
+    # limit of rename_limit per rename_window seconds per channel.
+    def __init__(self, latency=0.05, jitter=0.5, limit=5, window=5.0, seed=0, rename_limit=2, rename_window=600.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.limit = limit
+        self.window = window
+        self.random = random.Random(seed)
+        self.rename_limit = rename_limit
+        self.rename_window = rename_window
+        self.buckets = {}
+        self.calls = Counter()
+        self.rate_limited = 0
+
+    def reset(self):
+        self.calls.clear()
+        self.rate_limited = 0
+
+    async def request(self, route, major, limited=True):
+        self.calls[route] += 1
+        if limited and self.limit:
+            await self.wait_for_slot((route, major), self.limit, self.window)
+        delay = self.latency * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        await asyncio.sleep(max(0.0, delay))
+
+    async def wait_for_slot(self, key, limit, window):
+        bucket = self.buckets.setdefault(key, deque())
+        while True:
+            now = time.perf_counter()
+            while bucket and bucket[0] <= now - window:
+                bucket.popleft()
+            if len(bucket) < limit:
+                break
+            self.rate_limited += 1
+            await asyncio.sleep(bucket[0] + window - now)
+        bucket.append(time.perf_counter())
+
+    async def rename(self, channel_id):
+        if self.rename_limit:
+            await self.wait_for_slot(('rename', channel_id), self.rename_limit, self.rename_window)
+
+class FakeRole:
+    def __init__(self, id):
+        self.id = id
+        self.name = f'role-{id}'
+        self.mention = f'<@&{id}>'
+
+class FakeMessage:
+    def __init__(self, channel, author, content=None, embed=None, view=None):
+        self.id = next(ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, embed=None, **kwargs):
+        await self.channel.api.request('PATCH /channels/{id}/messages/{id}', self.channel.id)
+        if embed is not None:
+            self.embed = embed
+
+class FakeTextChannel:
+    def __init__(self, guild, name, category=None):
+        self.id = next(ids)
+        self.guild = guild
+        self.api = guild.api
+        self.name = name
+        self.mention = f'<#{self.id}>'
+        self.category = category
+        self.overwrites = {}
+        self.messages = {}
+        self.text_channels = []
+
+    @property
+    def category_id(self):
+        return self.category.id if self.category else None
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        await self.api.request('POST /channels/{id}/messages', self.id)
+        message = FakeMessage(self, self.guild.me, content, embed, view)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.api.request('GET /channels/{id}/messages/{id}', self.id)
+        return self.messages[message_id]
+
+    async def history(self, limit=100):
+        await self.api.request('GET /channels/{id}/messages', self.id)
+        for message in list(self.messages.values())[-limit:]:
+            yield message
+
+    async def edit(self, name=None, overwrites=None, **kwargs):
+        if name is not None and name != self.name:
+            await self.api.rename(self.id)
+        await self.api.request('PATCH /channels/{id}', self.id)
+        if name is not None:
+            self.name = name
+        if overwrites is not None:
+            self.overwrites = overwrites
+
+    async def purge(self, limit=None, **kwargs):
+        await self.api.request('POST /channels/{id}/messages/bulk-delete', self.id)
+        deleted = list(self.messages.values())[:limit]
+        for message in deleted:
+            del self.messages[message.id]
+        return deleted
+
+    async def delete(self, **kwargs):
+        await self.api.request('DELETE /channels/{id}', self.id)
+        self.guild.channels.pop(self.id, None)
+        if self.category and self in self.category.text_channels:
+            self.category.text_channels.remove(self)
+
+class FakeMember:
+    def __init__(self, guild, id, name=None):
+        self.id = id
+        self.guild = guild
+        self.name = name or f'user{id}'
+        self.display_name = self.name
+        self.mention = f'<@{id}>'
+        self.bot = False
+        self.roles = [guild.default_role]
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def edit(self, roles=None, **kwargs):
+        await self.guild.api.request('PATCH /guilds/{id}/members/{id}', self.guild.id)
+        if roles is not None:
+            self.roles = [self.guild.default_role] + [self.guild.get_role(role.id) or FakeRole(role.id) for role in roles]
+
+    async def send(self, content=None, **kwargs):
+        await self.guild.api.request('POST /channels/{id}/messages', ('dm', self.id))
+
+class FakeGuild:
+    def __init__(self, api, id=None):
+        self.id = id or next(ids)
+        self.api = api
+        self.default_role = FakeRole(self.id)
+        self.roles = {self.id: self.default_role}
+        self.channels = {}
+        self.members = {}
+        self.me = FakeMember(self, next(ids), 'bot')
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def add_role(self):
+        role = FakeRole(next(ids))
+        self.roles[role.id] = role
+        return role
+
+    def add_member(self, user_id=None):
+        member = FakeMember(self, user_id or next(ids))
+        self.members[member.id] = member
+        return member
+
+    def add_channel(self, name, category=None):
+        channel = FakeTextChannel(self, name, category)
+        self.channels[channel.id] = channel
+        if category:
+            category.text_channels.append(channel)
+        return channel
+
+    async def create_text_channel(self, name, category=None, **kwargs):
+        await self.api.request('POST /guilds/{id}/channels', self.id)
+        channel = self.add_channel(name, category)
+        channel.overwrites = kwargs.get('overwrites') or {}
+        return channel
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def callback(self, finished):
+        if self.done:
+            raise RuntimeError('Interaction already responded to')
+        self.done = True
+        await self.interaction.api.request('POST /interactions/{id}/{token}/callback', self.interaction.id, limited=False)
+        if finished:
+            self.interaction.finish()
+
+    async def defer(self, **kwargs):
+        await self.callback(False)
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.replies.append(content)
+        await self.callback(True)
+
+    async def send_modal(self, modal):
+        self.interaction.replies.append(modal)
+        await self.callback(True)
+
+    async def edit_message(self, **kwargs):
+        await self.callback(True)
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.replies.append(content)
+        await self.interaction.api.request('POST /webhooks/{id}/{token}', self.interaction.id, limited=False)
+        self.interaction.finish()
+
+class FakeInteraction:
+    # latency is the time from creation until the reply that ends the
+    # interaction, a plain response or the followup after a defer.
+    def __init__(self, guild, user):
+        self.id = next(ids)
+        self.api = guild.api
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.channel = None
+        self.command = None
+        self.extras = {}
+        self.created_at = discord.utils.utcnow()
+        self.replies = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.created = time.perf_counter()
+        self.finished = asyncio.Event()
+        self.latency = None
+
+    def finish(self):
+        if self.latency is None:
+            self.latency = time.perf_counter() - self.created
+        self.finished.set()
+
+class FakeBot:
+    def __init__(self, guilds):
+        self.guilds = list(guilds)
+        self.user = guilds[0].me
+        self.views = []
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def get_channel(self, channel_id):
+        for guild in self.guilds:
+            channel = guild.channels.get(channel_id)
+            if channel:
+                return channel
+        return None
+
+    def add_view(self, view, message_id=None):
+        self.views.append(view)
+
+    def dispatch(self, event, *args):
+        pass
+
+    def is_ready(self):
+        return True
+
+    async def wait_until_ready(self):
+        pass
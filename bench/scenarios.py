@@ -0,0 +1,185 @@
+import asyncio
+import os
+import random
+from contextlib import asynccontextmanager
+from cogs import db as queuedb
+from cogs.config import guild_configs, QUEUE_REGIONS, TIERS
+from cogs.queue import QueueCog, QUEUE_REFRESH_SECONDS
+from cogs.roles import ROLE_BATCH_SECONDS
+from cogs.user_cache import UserInfoCache
+from cogs.verify import VerifyCog
+from .fakes import FakeBot, FakeGuild, FakeInteraction
+
+SEED_CHUNK = 10_000
+
+class SqlCounter:
+    # Installed as the trace callback of every connection, so it sees each
+    # statement sqlite runs, including every row of an executemany.
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement):
+        self.count += 1
+
+class Result:
+    def __init__(self, scenario, action, latencies, sql, calls, rate_limited):
+        self.scenario = scenario
+        self.action = action
+        self.latencies = latencies
+        self.sql = sql
+        self.calls = calls
+        self.rate_limited = rate_limited
+
+class Bench:
+    # One scenario run: a fresh database and cogs loaded against a fake bot
+    # with a single guild. Only work inside `measure` blocks is reported.
+    def __init__(self, api, workdir, scenario, seed=0):
+        self.api = api
+        self.workdir = workdir
+        self.scenario = scenario
+        self.random = random.Random(seed)
+        self.sql = SqlCounter()
+        self.results = []
+        self.guild = FakeGuild(api)
+        self.bot = FakeBot([self.guild])
+        self.queue = None
+        self.verify = None
+
+    async def start(self):
+        # The db module keeps its connections and caches at module level.
+        queuedb.database = queuedb.Database(os.path.join(self.workdir, f'{self.scenario}.db'))
+        queuedb.user_cache = UserInfoCache(queuedb.USER_CACHE_SIZE)
+        queuedb.tier_counts.clear()
+        guild_configs.configs = {}
+        guild_configs.loaded = False
+        self.queue = QueueCog(self.bot)
+        await self.queue.cog_load()
+        self.verify = VerifyCog(self.bot)
+        await self.verify.cog_load()
+        database = queuedb.database
+        for conn in [database.writer_conn] + database.all_readers:
+            await conn.set_trace_callback(self.sql)
+        guild = self.guild
+        settings = {
+            'queue_channel': guild.add_channel('queue').id,
+            'announce_channel': guild.add_channel('results').id,
+            'verify_channel': guild.add_channel('verify').id,
+            'ticket_category': guild.add_channel('tickets').id,
+            'tester_role': guild.add_role().id,
+            'waitlist_role': guild.add_role().id,
+            'queue_access_role': guild.add_role().id,
+            'queue_max': 1_000_000,
+        }
+        settings.update({f'tier_role:{tier}': guild.add_role().id for tier in TIERS})
+        for key, value in settings.items():
+            await guild_configs.set(guild.id, key, value)
+
+    async def stop(self):
+        await self.verify.cog_unload()
+        await self.queue.cog_unload()
+
+    def interaction(self, member):
+        return FakeInteraction(self.guild, member)
+
+    def add_tester(self):
+        member = self.guild.add_member()
+        member.roles.append(self.guild.get_role(guild_configs.get(self.guild.id).tester_role_id))
+        return member
+
+    async def add_players(self, count):
+        members = [self.guild.add_member() for _ in range(count)]
+        for member in members:
+            await queuedb.save_user_info(self.guild.id, member.id, member.name, self.random.choice(QUEUE_REGIONS))
+        return members
+
+    async def run(self, command, cog, member, *args):
+        interaction = self.interaction(member)
+        await command.callback(cog, interaction, *args)
+        await interaction.finished.wait()
+        return interaction
+
+    async def join(self, members, seconds=0.0):
+        interactions = []
+        async def click(member, delay):
+            await asyncio.sleep(delay)
+            interaction = self.interaction(member)
+            interactions.append(interaction)
+            await self.queue.handle_join_queue(interaction)
+            await interaction.finished.wait()
+        await asyncio.gather(*(click(member, i * seconds / len(members)) for i, member in enumerate(members)))
+        return interactions
+
+    async def settle(self):
+        # Queue embeds and role edits are batched in the background; their
+        # API calls belong to the actions that caused them.
+        await asyncio.sleep(max(QUEUE_REFRESH_SECONDS, ROLE_BATCH_SECONDS) + self.api.latency * 4 + 0.1)
+
+    @asynccontextmanager
+    async def measure(self, action):
+        self.api.reset()
+        self.sql.count = 0
+        interactions = []
+        yield interactions
+        await self.settle()
+        self.results.append(Result(
+            self.scenario, action,
+            [interaction.latency for interaction in interactions if interaction.latency is not None],
+            self.sql.count, dict(self.api.calls), self.api.rate_limited
+        ))
+
+async def join_burst(bench, users=500, seconds=2.0, **_):
+    # Everyone clicks Join Queue within a couple of seconds of it opening.
+    await bench.run(QueueCog.start, bench.queue, bench.add_tester())
+    members = await bench.add_players(users)
+    async with bench.measure('join') as interactions:
+        interactions.extend(await bench.join(members, seconds))
+
+async def concurrent_next(bench, testers=5, rounds=20, **_):
+    # Several testers working through a full queue at the same time.
+    staff = [bench.add_tester() for _ in range(testers)]
+    for tester in staff:
+        await bench.run(QueueCog.start, bench.queue, tester)
+    await bench.join(await bench.add_players(testers * rounds))
+    async with bench.measure('next') as interactions:
+        async def test(tester):
+            for i in range(rounds):
+                interaction = bench.interaction(tester)
+                interactions.append(interaction)
+                await QueueCog.next.callback(bench.queue, interaction, TIERS[i % len(TIERS)])
+                await interaction.finished.wait()
+        await asyncio.gather(*(test(tester) for tester in staff))
+
+async def large_user_info(bench, rows=100_000, users=500, seconds=2.0, **_):
+    # Verification and joins against a big user_info table with a cold cache.
+    guild_id = bench.guild.id
+    first_id = 1_000_000
+    async with queuedb.database.writer() as db:
+        for start in range(0, rows, SEED_CHUNK):
+            await db.executemany(
+                'INSERT INTO user_info (guild_id, user_id, ign, ign_key, region) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (guild_id, first_id + i, f'Player{i}', queuedb.normalize_ign(f'Player{i}'), QUEUE_REGIONS[i % len(QUEUE_REGIONS)])
+                    for i in range(start, min(rows, start + SEED_CHUNK))
+                ]
+            )
+    await bench.run(QueueCog.start, bench.queue, bench.add_tester())
+    picked = bench.random.sample(range(rows), min(rows, users * 2))
+    verifying = [bench.guild.add_member(first_id + i) for i in picked[:users]]
+    joining = [bench.guild.add_member(first_id + i) for i in picked[users:]]
+    async with bench.measure('verify') as interactions:
+        async def verify(member, delay):
+            await asyncio.sleep(delay)
+            interaction = bench.interaction(member)
+            interactions.append(interaction)
+            index = member.id - first_id
+            await bench.verify.handle_verification(interaction, QUEUE_REGIONS[index % len(QUEUE_REGIONS)], f'Player{index}')
+            await interaction.finished.wait()
+        await asyncio.gather(*(verify(member, i * seconds / len(verifying)) for i, member in enumerate(verifying)))
+    async with bench.measure('join') as interactions:
+        interactions.extend(await bench.join(joining, seconds))
+
+SCENARIOS = {
+    'join_burst': join_burst,
+    'concurrent_next': concurrent_next,
+    'large_user_info': large_user_info,
+}
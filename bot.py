@@ -1,37 +1,69 @@
 import os
+import hashlib
+import json
 import discord
 from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
+from cogs import db as queuedb
+from cogs.startup import phase, since_start
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 GUILD_ID = os.getenv('GUILD_ID')
+# Rate limit waits longer than this raise RateLimited instead of sleeping
+# inside the request, so the dispatcher can park the route and free its
+# worker. discord.py will not go below 30 seconds.
+MAX_RATELIMIT_TIMEOUT = float(os.getenv('MAX_RATELIMIT_TIMEOUT', 30))
 
 intents = discord.Intents.default()
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents, max_ratelimit_timeout=MAX_RATELIMIT_TIMEOUT)
+
+@bot.event
+async def setup_hook():
+    await sync_commands()
 
 @bot.event
 async def on_ready():
-    print(f'Logged in as {bot.user}')
+    print(f'Logged in as {bot.user} ({since_start():.1f}s after start)')
+
+async def sync_commands():
+    # Syncing is slow and rate limited, so it only happens when the commands
+    # differ from what was last synced for this application.
+    commands_json = json.dumps([command.to_dict(bot.tree) for command in bot.tree.get_commands()], sort_keys=True)
+    tree_hash = hashlib.sha256(f'{bot.application_id}:{commands_json}'.encode()).hexdigest()
     try:
-        synced = await bot.tree.sync()
+        if await queuedb.get_bot_state('command_tree_hash') == tree_hash:
+            print('Commands unchanged, skipping sync')
+            return
+        with phase('command sync'):
+            synced = await bot.tree.sync()
+        await queuedb.set_bot_state('command_tree_hash', tree_hash)
         print(f'Synced {len(synced)} commands')
     except Exception as e:
         print(e)
 
 async def load_cogs():
-    for cog in ['cogs.queue', 'cogs.verify']:
+    for cog in ['cogs.config', 'cogs.stats', 'cogs.queue', 'cogs.verify', 'cogs.results', 'cogs.admin']:
         try:
-            await bot.load_extension(cog)
+            with phase(f'load {cog}'):
+                await bot.load_extension(cog)
         except Exception as e:
             print(f'Failed to load {cog}: {e}')
 
 if __name__ == '__main__':
     import asyncio
     async def main():
+        # A database that cannot be migrated stops startup here, before an
+        # empty command tree could be synced over the real one.
+        try:
+            await queuedb.init_db()
+        except RuntimeError as e:
+            print(e)
+            await queuedb.close_db()
+            return
         await load_cogs()
         await bot.start(TOKEN)
     asyncio.run(main())
@@ -0,0 +1,152 @@
+import discord
+from discord.ext import commands
+from discord import app_commands, Interaction
+import aiohttp
+import asyncio
+import io
+import os
+import tempfile
+import time
+from dotenv import load_dotenv
+from . import db as queuedb
+from .config import guild_configs
+from .retier import RetierJob
+from .transfer import import_file, export_file, detect_format, FORMATS
+
+load_dotenv()
+PROGRESS_SECONDS = float(os.getenv('ADMIN_PROGRESS_SECONDS', 5))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+KIND_CHOICES = [
+    app_commands.Choice(name='User info', value='users'),
+    app_commands.Choice(name='Test results', value='results'),
+]
+FORMAT_CHOICES = [app_commands.Choice(name=fmt.upper(), value=fmt) for fmt in FORMATS]
+
+def describe_import(report):
+    text = f"Read {report['read']} record(s): {report['imported']} imported, {report['skipped']} skipped."
+    if report['errors']:
+        text += '\n' + '\n'.join(report['errors'])
+    return text
+
+class AdminCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.jobs = {}
+        self.reporters = set()
+
+    async def cog_load(self):
+        await queuedb.open_db(self)
+
+    async def cog_unload(self):
+        for job in self.jobs.values():
+            await job.cancel()
+        self.jobs = {}
+        await asyncio.gather(*self.reporters, return_exceptions=True)
+        await queuedb.close_db(self)
+
+    async def download(self, attachment, f):
+        # Streamed to disk in chunks instead of attachment.read(), which
+        # would hold the whole upload in memory.
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        f.seek(0)
+
+    @app_commands.command(name='import', description='(Admin) Import user info or test results from a CSV or JSONL file')
+    @app_commands.describe(kind='What the file holds', file='A .csv or .jsonl file with a header/keys matching /export')
+    @app_commands.choices(kind=KIND_CHOICES)
+    @app_commands.checks.has_permissions(administrator=True)
+    async def import_data(self, interaction: Interaction, kind: str, file: discord.Attachment):
+        fmt = detect_format(file.filename)
+        if fmt is None:
+            await interaction.response.send_message('The file must be a .csv or .jsonl file.', ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        last_update = time.monotonic()
+        async def progress(report):
+            nonlocal last_update
+            if time.monotonic() - last_update < PROGRESS_SECONDS:
+                return
+            last_update = time.monotonic()
+            try:
+                await interaction.edit_original_response(content=f"Importing... {report['read']} record(s) read, {report['imported']} imported.")
+            except discord.HTTPException:
+                pass
+        with tempfile.TemporaryFile() as raw:
+            try:
+                await self.download(file, raw)
+            except aiohttp.ClientError as e:
+                await interaction.followup.send(f'Failed to download the file: {e}', ephemeral=True)
+                return
+            try:
+                with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as f:
+                    report = await import_file(kind, interaction.guild_id, f, fmt, progress)
+                message = describe_import(report)
+            except Exception as e:
+                print(f'Import into guild {interaction.guild_id} failed: {e}')
+                message = f'The import stopped with an error: {e}'
+        # Batches written before an error stay imported.
+        if kind == 'users':
+            self.bot.dispatch('user_info_import', interaction.guild_id)
+        await interaction.followup.send(message[:2000], ephemeral=True)
+
+    @app_commands.command(name='export', description='(Admin) Export user info or test results as a file')
+    @app_commands.describe(kind='What to export', format='File format; CSV by default')
+    @app_commands.choices(kind=KIND_CHOICES, format=FORMAT_CHOICES)
+    @app_commands.checks.has_permissions(administrator=True)
+    async def export_data(self, interaction: Interaction, kind: str, format: str = 'csv'):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        with tempfile.TemporaryFile() as raw:
+            f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            count = await export_file(kind, interaction.guild_id, f, format)
+            f.flush()
+            f.detach()
+            size = raw.tell()
+            if size > interaction.guild.filesize_limit:
+                await interaction.followup.send(f'The export is {size / 1e6:.1f} MB, over this server\'s upload limit; use `python manage.py export` instead.', ephemeral=True)
+                return
+            raw.seek(0)
+            await interaction.followup.send(
+                f'Exported {count} row(s).',
+                file=discord.File(raw, filename=f'{kind}-{interaction.guild_id}.{format}'),
+                ephemeral=True
+            )
+
+    @app_commands.command(name='retier', description='(Admin) Re-apply tier roles to every member from their latest result')
+    @app_commands.checks.has_permissions(administrator=True)
+    async def retier(self, interaction: Interaction):
+        job = self.jobs.get(interaction.guild_id)
+        if job and not job.done:
+            await interaction.response.send_message(job.progress(), ephemeral=True)
+            return
+        tier_role_ids = guild_configs.get(interaction.guild_id).tier_role_ids()
+        if not any(tier_role_ids.values()):
+            await interaction.response.send_message('No tier roles are configured; set them with /config first.', ephemeral=True)
+            return
+        job = self.jobs[interaction.guild_id] = RetierJob(interaction.guild, tier_role_ids)
+        job.start()
+        await interaction.response.send_message('Re-tier started.', ephemeral=True)
+        reporter = asyncio.create_task(self.report_progress(interaction, job))
+        self.reporters.add(reporter)
+        reporter.add_done_callback(self.reporters.discard)
+
+    async def report_progress(self, interaction, job):
+        # The reply is edited with progress until the job ends or the
+        # interaction token expires; /retier again shows it either way.
+        while True:
+            await asyncio.wait([job.task], timeout=PROGRESS_SECONDS)
+            try:
+                await interaction.edit_original_response(content=job.progress())
+            except discord.HTTPException:
+                break
+            if job.done:
+                break
+        await asyncio.wait([job.task])
+        if not job.task.cancelled() and job.task.exception():
+            print(f'Re-tier of guild {interaction.guild_id} failed: {job.task.exception()}')
+
+async def setup(bot):
+    await bot.add_cog(AdminCog(bot))
@@ -0,0 +1,204 @@
+import discord
+from discord.ext import commands
+from discord import app_commands, Interaction
+import os
+import re
+from dotenv import load_dotenv
+from . import db as queuedb
+
+load_dotenv()
+QUEUE_REGIONS = [r.strip().upper() for r in os.getenv('QUEUE_REGIONS', 'NA,EU').split(',') if r.strip()] or ['NA']
+TIERS = ['LT5', 'HT5', 'LT4', 'HT4', 'LT3', 'HT3', 'LT2', 'HT2', 'LT1', 'HT1']
+QUEUE_MAX = int(os.getenv('QUEUE_MAX', 20))
+TEST_INTERVAL_DAYS = int(os.getenv('TEST_INTERVAL_DAYS', 3))
+TIER_ROLE_IDS = {
+    'LT5': 0,  #Add role ids where 0 goes
+    'HT5': 0,
+    'LT4': 0,
+    'HT4': 0,
+    'LT3': 0,
+    'HT3': 0,
+    'LT2': 0,
+    'HT2': 0,
+    'LT1': 0,
+    'HT1': 0
+}
+
+# Settings an admin can change with /config, and what kind of value each takes.
+SETTINGS = {
+    'queue_channel': 'channel',
+    'announce_channel': 'channel',
+    'verify_channel': 'channel',
+    'ticket_category': 'channel',
+    'tester_role': 'role',
+    'waitlist_role': 'role',
+    'queue_access_role': 'role',
+    'queue_max': 'number',
+    'test_interval_days': 'number',
+}
+SETTINGS.update({f'queue_channel:{r}': 'channel' for r in QUEUE_REGIONS})
+SETTINGS.update({f'queue_max:{r}': 'number' for r in QUEUE_REGIONS})
+SETTINGS.update({f'tier_role:{t}': 'role' for t in TIERS})
+
+def env_settings():
+    # How a single-server deployment was configured; this becomes the config
+    # of GUILD_ID the first time it starts with multi-guild support.
+    values = {
+        'queue_channel': os.getenv('QUEUE_CHANNEL_ID'),
+        'announce_channel': os.getenv('TIER_ANNOUNCE_CHANNEL_ID'),
+        'verify_channel': os.getenv('VERIFY_CHANNEL_ID'),
+        'ticket_category': os.getenv('TICKET_CATEGORY_ID'),
+        'tester_role': os.getenv('TESTER_ROLE_ID'),
+        'waitlist_role': os.getenv('WAITLIST_ROLE_ID'),
+        'queue_access_role': os.getenv('QUEUE_ACCESS_ROLE_ID'),
+    }
+    for r in QUEUE_REGIONS:
+        values[f'queue_channel:{r}'] = os.getenv(f'QUEUE_CHANNEL_ID_{r}')
+        values[f'queue_max:{r}'] = os.getenv(f'QUEUE_MAX_{r}')
+    for tier, role_id in TIER_ROLE_IDS.items():
+        values[f'tier_role:{tier}'] = role_id
+    return {key: int(value) for key, value in values.items() if value and int(value)}
+
+class GuildConfig:
+    def __init__(self, guild_id, values=None):
+        self.guild_id = guild_id
+        self.values = values or {}
+
+    def get(self, key, default=0):
+        return self.values.get(key) or default
+
+    def queue_channel_id(self, region):
+        return self.get(f'queue_channel:{region}') or self.get('queue_channel')
+
+    def queue_max(self, region):
+        return self.get(f'queue_max:{region}') or self.get('queue_max', QUEUE_MAX)
+
+    @property
+    def announce_channel_id(self):
+        return self.get('announce_channel')
+
+    @property
+    def verify_channel_id(self):
+        return self.get('verify_channel')
+
+    @property
+    def ticket_category_id(self):
+        return self.get('ticket_category')
+
+    @property
+    def tester_role_id(self):
+        return self.get('tester_role')
+
+    @property
+    def waitlist_role_id(self):
+        return self.get('waitlist_role')
+
+    @property
+    def queue_access_role_id(self):
+        return self.get('queue_access_role')
+
+    @property
+    def test_interval(self):
+        return self.get('test_interval_days', TEST_INTERVAL_DAYS) * 86400
+
+    def tier_role_ids(self):
+        return {tier: self.get(f'tier_role:{tier}') for tier in TIERS}
+
+class GuildConfigs:
+    # Every guild's settings, loaded once and kept in memory. Guilds without
+    # any settings get an empty config, so nothing is posted anywhere until an
+    # admin sets it up.
+    def __init__(self):
+        self.configs = {}
+        self.loaded = False
+
+    async def load(self):
+        if self.loaded:
+            return
+        self.configs = {guild_id: GuildConfig(guild_id, values) for guild_id, values in (await queuedb.load_guild_configs()).items()}
+        legacy = queuedb.LEGACY_GUILD_ID
+        if legacy and legacy not in self.configs:
+            values = env_settings()
+            await queuedb.save_guild_config(legacy, values)
+            self.configs[legacy] = GuildConfig(legacy, values)
+        self.loaded = True
+
+    def get(self, guild_id):
+        config = self.configs.get(guild_id)
+        if config is None:
+            config = self.configs[guild_id] = GuildConfig(guild_id)
+        return config
+
+    async def set(self, guild_id, key, value):
+        await queuedb.save_guild_config(guild_id, {key: value})
+        config = self.get(guild_id)
+        if value is None:
+            config.values.pop(key, None)
+        else:
+            config.values[key] = value
+
+guild_configs = GuildConfigs()
+
+def tester_only():
+    # has_role needs the id at import time; the tester role is per guild.
+    async def predicate(interaction: Interaction):
+        role_id = guild_configs.get(interaction.guild_id).tester_role_id
+        if isinstance(interaction.user, discord.Member) and role_id and interaction.user.get_role(role_id):
+            return True
+        raise app_commands.MissingRole(role_id)
+    return app_commands.check(predicate)
+
+class ConfigCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def cog_load(self):
+        await queuedb.open_db(self)
+        await guild_configs.load()
+
+    async def cog_unload(self):
+        await queuedb.close_db(self)
+
+    @app_commands.command(name='config', description='(Admin) Show or change a setting for this server')
+    @app_commands.describe(setting='Setting to change; leave empty to show all', value='Channel, role, number, or "none" to clear')
+    @app_commands.checks.has_permissions(administrator=True)
+    async def config(self, interaction: Interaction, setting: str = None, value: str = None):
+        config = guild_configs.get(interaction.guild_id)
+        if not setting:
+            lines = [f'{key}: {self.describe(key, config.values[key])}' for key in SETTINGS if key in config.values]
+            await interaction.response.send_message('\n'.join(lines) or 'Nothing is configured yet.', ephemeral=True)
+            return
+        if setting not in SETTINGS:
+            await interaction.response.send_message(f'Unknown setting. Valid settings: {", ".join(SETTINGS)}', ephemeral=True)
+            return
+        if value is None:
+            await interaction.response.send_message(f'{setting}: {self.describe(setting, config.values.get(setting))}', ephemeral=True)
+            return
+        if value.lower() == 'none':
+            parsed = None
+        else:
+            digits = re.sub(r'\D', '', value)
+            if not digits:
+                await interaction.response.send_message(f'{setting} takes a {SETTINGS[setting]}.', ephemeral=True)
+                return
+            parsed = int(digits)
+        await guild_configs.set(interaction.guild_id, setting, parsed)
+        self.bot.dispatch('guild_config_update', interaction.guild_id, setting)
+        await interaction.response.send_message(f'{setting} set to {self.describe(setting, parsed)}.', ephemeral=True)
+
+    @config.autocomplete('setting')
+    async def setting_autocomplete(self, interaction: Interaction, current: str):
+        return [app_commands.Choice(name=key, value=key) for key in SETTINGS if current.lower() in key][:25]
+
+    def describe(self, setting, value):
+        if not value:
+            return 'not set'
+        kind = SETTINGS[setting]
+        if kind == 'channel':
+            return f'<#{value}>'
+        if kind == 'role':
+            return f'<@&{value}>'
+        return str(value)
+
+async def setup(bot):
+    await bot.add_cog(ConfigCog(bot))
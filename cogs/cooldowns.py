@@ -0,0 +1,65 @@
+import asyncio
+import heapq
+import time
+
+class CooldownScheduler:
+    # Min-heap of cooldown expiries. The task sleeps until the earliest one,
+    # then hands every user whose cooldown has ended to `on_expired` in one
+    # batch. `until` holds the current expiry per user, so eligibility checks
+    # are a dict lookup and rescheduled users leave stale heap entries that
+    # are skipped when popped.
+    def __init__(self, on_expired):
+        self.on_expired = on_expired
+        self.heap = []
+        self.until = {}
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def schedule(self, user_id, until):
+        self.until[user_id] = until
+        heapq.heappush(self.heap, (until, user_id))
+        if self.heap[0] == (until, user_id):
+            self.changed.set()
+
+    def remaining(self, user_id, now=None):
+        until = self.until.get(user_id)
+        if until is None:
+            return 0
+        return max(0, until - (now or time.time()))
+
+    def due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now:
+            until, user_id = heapq.heappop(self.heap)
+            if self.until.get(user_id) == until:
+                del self.until[user_id]
+                batch.append((user_id, until))
+        return batch
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            delay = self.heap[0][0] - time.time() if self.heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = self.due(time.time())
+            if not batch:
+                continue
+            try:
+                await self.on_expired(batch)
+            except Exception as e:
+                print(f'Failed to lift {len(batch)} cooldown(s): {e}')
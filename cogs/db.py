@@ -1,110 +1,948 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
 import aiosqlite
+from dotenv import load_dotenv
+from .user_cache import UserInfoCache, MISSING
+from .metrics import timed
 
+load_dotenv()
 DB_PATH = 'queuebot.db'
+READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', 3))
+STATEMENT_CACHE_SIZE = 256
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+EVENT_RETENTION_DAYS = int(os.getenv('QUEUE_EVENT_RETENTION_DAYS', 30))
+# Rows written before multi-guild support are assigned to this guild.
+LEGACY_GUILD_ID = int(os.getenv('GUILD_ID') or 0)
 
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA mmap_size=67108864',
+)
+
+class Database:
+    # One writer connection plus a small pool of read-only connections, opened
+    # once and reused. sqlite3 keeps a per-connection statement cache, so the
+    # parameterised queries below are prepared once per connection.
+    def __init__(self, path, readers=READ_POOL_SIZE):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self.writer_conn = None
+        self.readers = None
+        self.all_readers = []
+        self.write_lock = asyncio.Lock()
+        self.open_lock = asyncio.Lock()
+        self.owners = set()
+        self.schema_ready = False
+
+    @property
+    def is_open(self):
+        return self.writer_conn is not None
+
+    async def _connect(self, read_only=False):
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute('PRAGMA query_only=1')
+        return conn
+
+    async def open(self, owner=None):
+        async with self.open_lock:
+            if owner is not None:
+                self.owners.add(owner)
+            if self.is_open:
+                return
+            # The writer is opened first so WAL mode is set before readers attach.
+            self.writer_conn = await self._connect()
+            self.readers = asyncio.Queue()
+            for _ in range(self.reader_count):
+                conn = await self._connect(read_only=True)
+                self.all_readers.append(conn)
+                self.readers.put_nowait(conn)
+
+    async def close(self, owner=None):
+        # Owners are the cogs sharing the connections; the last one to
+        # unload actually closes them.
+        async with self.open_lock:
+            self.owners.discard(owner)
+            if self.owners or not self.is_open:
+                return
+            async with self.write_lock:
+                for conn in self.all_readers:
+                    await conn.close()
+                await self.writer_conn.execute('PRAGMA optimize')
+                await self.writer_conn.close()
+            self.writer_conn = None
+            self.readers = None
+            self.all_readers = []
+
+    async def _ensure_open(self):
+        if not self.is_open:
+            await self.open()
+
+    @asynccontextmanager
+    async def reader(self):
+        await self._ensure_open()
+        conn = await self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        await self._ensure_open()
+        async with self.write_lock:
+            try:
+                yield self.writer_conn
+            except BaseException:
+                await self.writer_conn.rollback()
+                raise
+            else:
+                await self.writer_conn.commit()
+
+database = Database(DB_PATH)
+user_cache = UserInfoCache(USER_CACHE_SIZE)
+
+async def open_db(owner=None):
+    await database.open(owner)
+
+async def close_db(owner=None):
+    await database.close(owner)
+
+class QueueChanges:
+    # Queue mutations made by one interaction in one guild, in order. They are
+    # appended to queue_events in a single transaction by apply_queue_changes;
+    # the queue tables are only brought up to date when the log is compacted.
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.events = []
+        self.tested = {}
+        self.results = []
+
+    def __bool__(self):
+        return bool(self.events or self.tested or self.results)
+
+    def record(self, kind, user_id=None, **data):
+        self.events.append((kind, user_id, data))
+
+    def set_state(self, queue_open):
+        self.record('state', queue_open=int(queue_open))
+
+    def set_shard(self, region, channel_id, message_id):
+        self.record('shard', region=region, channel_id=channel_id, message_id=message_id)
+
+    def join(self, user_id, position, region):
+        self.record('join', user_id, position=position, region=region)
+
+    def leave(self, user_id):
+        self.record('leave', user_id)
+
+    def pop(self, user_id):
+        self.record('pop', user_id)
+
+    def add_tester(self, user_id, region):
+        self.record('tester_start', user_id, region=region)
+
+    def remove_tester(self, user_id):
+        self.record('tester_stop', user_id)
+
+    def add_result(self, tester_id, testee_id, tier, tier_rank, region, tested_at, cooldown_until):
+        # Results and user_info are not queue state, so they are written
+        # straight away rather than on compaction; the event is the audit entry.
+        self.record('tier', testee_id, tester_id=tester_id, tier=tier, region=region)
+        self.tested[testee_id] = (tested_at, cooldown_until)
+        self.results.append((testee_id, tester_id, tier, tier_rank, region, tested_at))
+
+    def save_session(self, tester_id, testee_id, ticket_channel_id, started_at):
+        self.record('session', tester_id, testee_id=testee_id, ticket_channel_id=ticket_channel_id, started_at=started_at)
+
+    def end_session(self, tester_id):
+        self.record('session_end', tester_id)
+
+SCHEMA = {
+    'guild_config': '''
+        CREATE TABLE IF NOT EXISTS guild_config (
+            guild_id INTEGER,
+            key TEXT,
+            value INTEGER,
+            PRIMARY KEY (guild_id, key)
+        )
+    ''',
+    'bot_state': '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''',
+    # Channels the ticket pool manages, idle or in use, with the times they
+    # were last renamed so the per-channel rename limit survives restarts.
+    'ticket_channels': '''
+        CREATE TABLE IF NOT EXISTS ticket_channels (
+            channel_id INTEGER PRIMARY KEY,
+            guild_id INTEGER,
+            idle INTEGER,
+            renamed_at TEXT
+        )
+    ''',
+    'verify_messages': '''
+        CREATE TABLE IF NOT EXISTS verify_messages (
+            guild_id INTEGER PRIMARY KEY,
+            channel_id INTEGER,
+            message_id INTEGER
+        )
+    ''',
+    'queue_state': '''
+        CREATE TABLE IF NOT EXISTS queue_state (
+            guild_id INTEGER PRIMARY KEY,
+            queue_open INTEGER,
+            queue_message_id INTEGER,
+            queue_channel_id INTEGER
+        )
+    ''',
+    'queue_members': '''
+        CREATE TABLE IF NOT EXISTS queue_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER,
+            user_id INTEGER,
+            position INTEGER,
+            region TEXT,
+            UNIQUE (guild_id, user_id)
+        )
+    ''',
+    'active_testers': '''
+        CREATE TABLE IF NOT EXISTS active_testers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER,
+            user_id INTEGER,
+            region TEXT,
+            UNIQUE (guild_id, user_id)
+        )
+    ''',
+    'queue_shards': '''
+        CREATE TABLE IF NOT EXISTS queue_shards (
+            guild_id INTEGER,
+            region TEXT,
+            channel_id INTEGER,
+            message_id INTEGER,
+            PRIMARY KEY (guild_id, region)
+        )
+    ''',
+    'test_sessions': '''
+        CREATE TABLE IF NOT EXISTS test_sessions (
+            guild_id INTEGER,
+            tester_id INTEGER,
+            testee_id INTEGER,
+            ticket_channel_id INTEGER,
+            started_at INTEGER,
+            PRIMARY KEY (guild_id, tester_id)
+        )
+    ''',
+    'queue_events': '''
+        CREATE TABLE IF NOT EXISTS queue_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER,
+            created_at INTEGER,
+            kind TEXT,
+            user_id INTEGER,
+            data TEXT
+        )
+    ''',
+    'queue_snapshot': '''
+        CREATE TABLE IF NOT EXISTS queue_snapshot (
+            id INTEGER PRIMARY KEY,
+            event_id INTEGER,
+            taken_at INTEGER
+        )
+    ''',
+    'test_results': '''
+        CREATE TABLE IF NOT EXISTS test_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER,
+            testee_id INTEGER,
+            tester_id INTEGER,
+            tier TEXT,
+            region TEXT,
+            tested_at INTEGER
+        )
+    ''',
+    # Latest result per player, kept alongside test_results for the leaderboard.
+    'player_tiers': '''
+        CREATE TABLE IF NOT EXISTS player_tiers (
+            guild_id INTEGER,
+            user_id INTEGER,
+            tier TEXT,
+            tier_rank INTEGER,
+            region TEXT,
+            tested_at INTEGER,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''',
+    'user_info': '''
+        CREATE TABLE IF NOT EXISTS user_info (
+            guild_id INTEGER,
+            user_id INTEGER,
+            ign TEXT,
+            ign_key TEXT,
+            region TEXT,
+            last_test_timestamp INTEGER,
+            cooldown_until INTEGER,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''',
+}
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_queue_members_guild_region_position ON queue_members (guild_id, region, position)',
+    'CREATE INDEX IF NOT EXISTS idx_test_results_guild_testee ON test_results (guild_id, testee_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_test_results_guild_tester ON test_results (guild_id, tester_id, tier)',
+    # user_id breaks ties so leaderboard pages can seek to the last row shown.
+    'CREATE INDEX IF NOT EXISTS idx_player_tiers_guild_rank_user ON player_tiers (guild_id, tier_rank DESC, tested_at, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_player_tiers_guild_region_rank_user ON player_tiers (guild_id, region, tier_rank DESC, tested_at, user_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_user_info_guild_ign_key ON user_info (guild_id, ign_key)',
+    'CREATE INDEX IF NOT EXISTS idx_user_info_cooldown_until ON user_info (cooldown_until) WHERE cooldown_until IS NOT NULL',
+)
+
+# Indexes from older databases that the ones above replace.
+LEGACY_INDEXES = (
+    'idx_player_tiers_guild_rank',
+    'idx_player_tiers_guild_region_rank',
+    'idx_queue_members_position',
+    'idx_queue_members_region_position',
+    'idx_test_results_testee',
+    'idx_test_results_tester',
+    'idx_player_tiers_rank',
+    'idx_player_tiers_region_rank',
+    'idx_user_info_ign_key',
+)
+
+# Tables whose keys gained guild_id, with the columns copied over when an
+# older database is rebuilt.
+GUILD_KEYED_TABLES = {
+    'queue_state': ('queue_open', 'queue_message_id', 'queue_channel_id'),
+    'queue_members': ('user_id', 'position', 'region'),
+    'active_testers': ('user_id', 'region'),
+    'queue_shards': ('region', 'channel_id', 'message_id'),
+    'test_sessions': ('tester_id', 'testee_id', 'ticket_channel_id', 'started_at'),
+    'player_tiers': ('user_id', 'tier', 'tier_rank', 'region', 'tested_at'),
+    'user_info': ('user_id', 'ign', 'ign_key', 'region', 'last_test_timestamp', 'cooldown_until'),
+}
+
+async def _columns(db, table):
+    async with db.execute(f'PRAGMA table_info({table})') as cursor:
+        return {row[1] async for row in cursor}
+
+async def _legacy_rows(db):
+    # Tables from before multi-guild support that still hold rows.
+    tables = []
+    for table in list(GUILD_KEYED_TABLES) + ['queue_events', 'test_results']:
+        if 'guild_id' in await _columns(db, table):
+            continue
+        async with db.execute(f'SELECT 1 FROM {table} LIMIT 1') as cursor:
+            if await cursor.fetchone():
+                tables.append(table)
+    return tables
+
+async def _requeue_legacy_testee(db):
+    # Single-server databases kept the player being tested in
+    # queue_state.current_testee, which the guild_id rebuild drops. They go
+    # back to the front of the queue rather than losing their place, with no
+    # region like the rest of that queue.
+    if 'current_testee' not in await _columns(db, 'queue_state'):
+        return
+    async with db.execute('SELECT current_testee FROM queue_state WHERE current_testee IS NOT NULL LIMIT 1') as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return
+    await db.execute(
+        'INSERT INTO queue_members (user_id, position) '
+        'SELECT ?, (SELECT COALESCE(MIN(position), 1) - 1 FROM queue_members) '
+        'WHERE NOT EXISTS (SELECT 1 FROM queue_members WHERE user_id = ?)',
+        (row[0], row[0])
+    )
+
+async def _add_guild_id(db, table, columns):
+    # Rows from before multi-guild support belong to LEGACY_GUILD_ID.
+    if 'guild_id' in await _columns(db, table):
+        return
+    await db.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+    await db.execute(SCHEMA[table])
+    names = ', '.join(columns)
+    await db.execute(f'INSERT INTO {table} (guild_id, {names}) SELECT ?, {names} FROM {table}_legacy', (LEGACY_GUILD_ID,))
+    await db.execute(f'DROP TABLE {table}_legacy')
+
+@timed('db')
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS queue_state (
-                id INTEGER PRIMARY KEY, 
-                queue_open INTEGER, 
-                queue_message_id INTEGER,
-                queue_channel_id INTEGER,
-                current_testee INTEGER,
-                previous_tier TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS queue_members (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE
+    # bot.py runs this before loading the cogs; later calls are no-ops.
+    async with database.writer() as db:
+        if database.schema_ready:
+            return
+        for sql in SCHEMA.values():
+            await db.execute(sql)
+        # Checked before anything is migrated: without GUILD_ID, single-server
+        # rows would silently belong to a guild 0 that does not exist.
+        legacy = await _legacy_rows(db)
+        if legacy and not LEGACY_GUILD_ID:
+            raise RuntimeError(
+                f'{DB_PATH} is from a single-server version of the bot (data in {", ".join(legacy)} has no guild). '
+                'Set GUILD_ID to the id of the server it belongs to so its data can be migrated, then restart.'
             )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS active_testers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE
+        # Columns added to single-server databases before guild_id existed.
+        if 'position' not in await _columns(db, 'queue_members'):
+            await db.execute('ALTER TABLE queue_members ADD COLUMN position INTEGER')
+            await db.execute('UPDATE queue_members SET position = id')
+        if 'region' not in await _columns(db, 'queue_members'):
+            await db.execute('ALTER TABLE queue_members ADD COLUMN region TEXT')
+        if 'region' not in await _columns(db, 'active_testers'):
+            await db.execute('ALTER TABLE active_testers ADD COLUMN region TEXT')
+        if 'ign_key' not in await _columns(db, 'user_info'):
+            await db.execute('ALTER TABLE user_info ADD COLUMN ign_key TEXT')
+            await _migrate_ign_keys(db)
+        if 'cooldown_until' not in await _columns(db, 'user_info'):
+            # Filled from last_test_timestamp by backfill_cooldowns, which
+            # knows each guild's test interval.
+            await db.execute('ALTER TABLE user_info ADD COLUMN cooldown_until INTEGER')
+        await _requeue_legacy_testee(db)
+        for table, columns in GUILD_KEYED_TABLES.items():
+            await _add_guild_id(db, table, columns)
+        for table in ('queue_events', 'test_results'):
+            if 'guild_id' not in await _columns(db, table):
+                await db.execute(f'ALTER TABLE {table} ADD COLUMN guild_id INTEGER')
+                await db.execute(f'UPDATE {table} SET guild_id = ?', (LEGACY_GUILD_ID,))
+        for name in LEGACY_INDEXES:
+            await db.execute(f'DROP INDEX IF EXISTS {name}')
+        for sql in INDEXES:
+            await db.execute(sql)
+        database.schema_ready = True
+
+def normalize_ign(ign):
+    return ign.strip().casefold() if ign else None
+
+async def _migrate_ign_keys(db):
+    # IGNs that only differ by case share a key. The most recently tested row
+    # keeps it so its cooldown still applies; the others are left without one.
+    keys = {}
+    async with db.execute('SELECT user_id, ign FROM user_info ORDER BY COALESCE(last_test_timestamp, 0) DESC, user_id DESC') as cursor:
+        async for user_id, ign in cursor:
+            key = normalize_ign(ign)
+            if key and key not in keys:
+                keys[key] = user_id
+    await db.executemany('UPDATE user_info SET ign_key = ? WHERE user_id = ?', list(keys.items()))
+
+@timed('db')
+async def load_guild_ids():
+    async with database.reader() as db:
+        async with db.execute('SELECT guild_id FROM queue_state UNION SELECT guild_id FROM guild_config') as cursor:
+            return {row[0] async for row in cursor}
+
+@timed('db')
+async def load_guild_configs():
+    configs = {}
+    async with database.reader() as db:
+        async with db.execute('SELECT guild_id, key, value FROM guild_config') as cursor:
+            async for guild_id, key, value in cursor:
+                configs.setdefault(guild_id, {})[key] = value
+    return configs
+
+@timed('db')
+async def save_guild_config(guild_id, values):
+    # values maps setting to value; None removes the setting.
+    async with database.writer() as db:
+        await db.executemany('DELETE FROM guild_config WHERE guild_id = ? AND key = ?', [(guild_id, key) for key, value in values.items() if value is None])
+        await db.executemany('REPLACE INTO guild_config (guild_id, key, value) VALUES (?, ?, ?)', [(guild_id, key, value) for key, value in values.items() if value is not None])
+
+@timed('db')
+async def get_bot_state(key):
+    async with database.reader() as db:
+        async with db.execute('SELECT value FROM bot_state WHERE key = ?', (key,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+@timed('db')
+async def set_bot_state(key, value):
+    async with database.writer() as db:
+        await db.execute('REPLACE INTO bot_state (key, value) VALUES (?, ?)', (key, value))
+
+@timed('db')
+async def load_verify_messages():
+    async with database.reader() as db:
+        async with db.execute('SELECT guild_id, channel_id, message_id FROM verify_messages') as cursor:
+            return {row[0]: (row[1], row[2]) async for row in cursor}
+
+@timed('db')
+async def save_verify_message(guild_id, channel_id, message_id):
+    async with database.writer() as db:
+        await db.execute('REPLACE INTO verify_messages (guild_id, channel_id, message_id) VALUES (?, ?, ?)', (guild_id, channel_id, message_id))
+
+@timed('db')
+async def load_ticket_channels(guild_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT channel_id, idle, renamed_at FROM ticket_channels WHERE guild_id = ?', (guild_id,)) as cursor:
+            return {row[0]: (bool(row[1]), json.loads(row[2]) if row[2] else []) async for row in cursor}
+
+@timed('db')
+async def save_ticket_channel(guild_id, channel_id, idle, renamed_at):
+    async with database.writer() as db:
+        await db.execute(
+            'REPLACE INTO ticket_channels (channel_id, guild_id, idle, renamed_at) VALUES (?, ?, ?, ?)',
+            (channel_id, guild_id, int(idle), json.dumps(renamed_at))
+        )
+
+@timed('db')
+async def delete_ticket_channel(channel_id):
+    async with database.writer() as db:
+        await db.execute('DELETE FROM ticket_channels WHERE channel_id = ?', (channel_id,))
+
+async def _write_queue_state(db, guild_id, queue_open):
+    # Only queue_open is still written. The other columns are read once from
+    # old databases: queue messages now live in queue_shards and tests in
+    # progress in test_sessions.
+    await db.execute('REPLACE INTO queue_state (guild_id, queue_open) VALUES (?, ?)', (guild_id, queue_open))
+
+@timed('db')
+async def apply_queue_changes(changes):
+    if not changes:
+        return
+    guild_id = changes.guild_id
+    now = int(time.time())
+    async with database.writer() as db:
+        if changes.events:
+            await db.executemany(
+                'INSERT INTO queue_events (guild_id, created_at, kind, user_id, data) VALUES (?, ?, ?, ?, ?)',
+                [(guild_id, now, kind, user_id, json.dumps(data) if data else None) for kind, user_id, data in changes.events]
             )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS user_info (
-                user_id INTEGER PRIMARY KEY,
-                ign TEXT,
-                region TEXT,
-                last_test_timestamp INTEGER
+        if changes.tested:
+            await db.executemany(
+                'UPDATE user_info SET last_test_timestamp = ?, cooldown_until = ? WHERE guild_id = ? AND user_id = ?',
+                [(ts, until, guild_id, user_id) for user_id, (ts, until) in changes.tested.items()]
             )
-        ''')
-        await db.commit()
+        replaced = await _record_results(db, guild_id, changes.results) if changes.results else []
+    for user_id, (ts, _) in changes.tested.items():
+        user_cache.update((guild_id, user_id), last_test_timestamp=ts)
+    for old, new in replaced:
+        _count_tier(guild_id, old, -1)
+        _count_tier(guild_id, new, 1)
 
-async def save_queue_state(queue_open, queue_message_id, queue_channel_id, current_testee, previous_tier):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('DELETE FROM queue_state')
+async def _apply_event(db, guild_id, kind, user_id, data):
+    if kind == 'state':
+        await _write_queue_state(db, guild_id, data['queue_open'])
+    elif kind == 'join':
+        await db.execute('INSERT OR REPLACE INTO queue_members (guild_id, user_id, position, region) VALUES (?, ?, ?, ?)', (guild_id, user_id, data['position'], data['region']))
+    elif kind in ('leave', 'pop'):
+        await db.execute('DELETE FROM queue_members WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
+    elif kind == 'tester_start':
+        await db.execute('INSERT OR REPLACE INTO active_testers (guild_id, user_id, region) VALUES (?, ?, ?)', (guild_id, user_id, data['region']))
+    elif kind == 'tester_stop':
+        await db.execute('DELETE FROM active_testers WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
+    elif kind == 'shard':
+        await db.execute('REPLACE INTO queue_shards (guild_id, region, channel_id, message_id) VALUES (?, ?, ?, ?)', (guild_id, data['region'], data['channel_id'], data['message_id']))
+    elif kind == 'session':
         await db.execute(
-            'INSERT INTO queue_state (queue_open, queue_message_id, queue_channel_id, current_testee, previous_tier) VALUES (?, ?, ?, ?, ?)',
-            (int(queue_open), queue_message_id, queue_channel_id, current_testee, previous_tier)
+            'REPLACE INTO test_sessions (guild_id, tester_id, testee_id, ticket_channel_id, started_at) VALUES (?, ?, ?, ?, ?)',
+            (guild_id, user_id, data['testee_id'], data['ticket_channel_id'], data['started_at'])
         )
-        await db.commit()
+    elif kind == 'session_end':
+        await db.execute('DELETE FROM test_sessions WHERE guild_id = ? AND tester_id = ?', (guild_id, user_id))
+    # 'tier' events are audit only.
+
+async def _snapshot_event_id(db):
+    async with db.execute('SELECT event_id FROM queue_snapshot WHERE id = 1') as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+async def _mark_snapshot(db, event_id):
+    now = int(time.time())
+    await db.execute('REPLACE INTO queue_snapshot (id, event_id, taken_at) VALUES (1, ?, ?)', (event_id, now))
+    # Events the snapshot already covers are kept for a while as an audit trail.
+    await db.execute('DELETE FROM queue_events WHERE id <= ? AND created_at < ?', (event_id, now - EVENT_RETENTION_DAYS * 86400))
+
+async def _replay_events(db):
+    # Applies every event after the last snapshot, for all guilds, in order.
+    event_id = await _snapshot_event_id(db)
+    async with db.execute('SELECT id, guild_id, kind, user_id, data FROM queue_events WHERE id > ? ORDER BY id', (event_id,)) as cursor:
+        events = await cursor.fetchall()
+    for row_id, guild_id, kind, user_id, data in events:
+        await _apply_event(db, guild_id, kind, user_id, json.loads(data) if data else {})
+        event_id = row_id
+    if events:
+        await _mark_snapshot(db, event_id)
+    return len(events)
 
-async def load_queue_state():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT queue_open, queue_message_id, queue_channel_id, current_testee, previous_tier FROM queue_state LIMIT 1') as cursor:
+@timed('db')
+async def compact_queue_events():
+    # Replays the events after the last snapshot into the queue tables and
+    # moves the snapshot past them. Returns how many were applied.
+    async with database.writer() as db:
+        return await _replay_events(db)
+
+@timed('db')
+async def save_queue_snapshot(guild_id, queue_open, members, testers, sessions, shards):
+    # Full rewrite of one guild from memory, which already reflects every
+    # event it logged. Other guilds' pending events are replayed first, since
+    # the snapshot marker is shared.
+    async with database.writer() as db:
+        await _replay_events(db)
+        await _write_queue_state(db, guild_id, int(queue_open))
+        await db.execute('DELETE FROM queue_members WHERE guild_id = ?', (guild_id,))
+        await db.executemany('INSERT INTO queue_members (guild_id, user_id, position, region) VALUES (?, ?, ?, ?)', [(guild_id,) + row for row in members])
+        await db.execute('DELETE FROM active_testers WHERE guild_id = ?', (guild_id,))
+        await db.executemany('INSERT INTO active_testers (guild_id, user_id, region) VALUES (?, ?, ?)', [(guild_id,) + row for row in testers])
+        await db.execute('DELETE FROM queue_shards WHERE guild_id = ?', (guild_id,))
+        await db.executemany('INSERT INTO queue_shards (guild_id, region, channel_id, message_id) VALUES (?, ?, ?, ?)', [(guild_id,) + row for row in shards])
+        await db.execute('DELETE FROM test_sessions WHERE guild_id = ?', (guild_id,))
+        await db.executemany('INSERT INTO test_sessions (guild_id, tester_id, testee_id, ticket_channel_id, started_at) VALUES (?, ?, ?, ?, ?)', [(guild_id,) + row for row in sessions])
+        async with db.execute('SELECT COALESCE(MAX(id), 0) FROM queue_events') as cursor:
+            await _mark_snapshot(db, (await cursor.fetchone())[0])
+
+@timed('db')
+async def load_queue_state(guild_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT queue_open, queue_message_id, queue_channel_id FROM queue_state WHERE guild_id = ?', (guild_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
                 return {
                     'queue_open': bool(row[0]),
                     'queue_message_id': row[1],
-                    'queue_channel_id': row[2],
-                    'current_testee': row[3],
-                    'previous_tier': row[4]
+                    'queue_channel_id': row[2]
                 }
             return None
 
-async def save_queue_members(members):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('DELETE FROM queue_members')
-        for user_id in members:
-            await db.execute('INSERT INTO queue_members (user_id) VALUES (?)', (user_id,))
-        await db.commit()
-
-async def load_queue_members():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT user_id FROM queue_members') as cursor:
-            return [row[0] async for row in cursor]
-
-async def save_active_testers(testers):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('DELETE FROM active_testers')
-        for user_id in testers:
-            await db.execute('INSERT INTO active_testers (user_id) VALUES (?)', (user_id,))
-        await db.commit()
-
-async def load_active_testers():
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT user_id FROM active_testers') as cursor:
-            return [row[0] async for row in cursor]
-
-async def save_user_info(user_id, ign, region):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('REPLACE INTO user_info (user_id, ign, region) VALUES (?, ?, ?)', (user_id, ign, region))
-        await db.commit()
-
-async def get_user_info(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT ign, region, last_test_timestamp FROM user_info WHERE user_id = ?', (user_id,)) as cursor:
+@timed('db')
+async def load_queue_members(guild_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT user_id, region FROM queue_members WHERE guild_id = ? ORDER BY region, position, id', (guild_id,)) as cursor:
+            return [(row[0], row[1]) async for row in cursor]
+
+@timed('db')
+async def load_active_testers(guild_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT user_id, region FROM active_testers WHERE guild_id = ?', (guild_id,)) as cursor:
+            return {row[0]: row[1] async for row in cursor}
+
+@timed('db')
+async def load_queue_shards(guild_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT region, channel_id, message_id FROM queue_shards WHERE guild_id = ?', (guild_id,)) as cursor:
+            return {row[0]: {'channel_id': row[1], 'message_id': row[2]} async for row in cursor}
+
+@timed('db')
+async def load_test_sessions(guild_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT tester_id, testee_id, ticket_channel_id, started_at FROM test_sessions WHERE guild_id = ?', (guild_id,)) as cursor:
+            return [
+                {
+                    'tester_id': row[0],
+                    'testee_id': row[1],
+                    'ticket_channel_id': row[2],
+                    'started_at': row[3]
+                }
+                async for row in cursor
+            ]
+
+async def _upsert_user_info(db, guild_id, user_id, ign, region):
+    key = normalize_ign(ign)
+    # An IGN belongs to one account; whoever verifies with it last takes it over.
+    await db.execute('UPDATE user_info SET ign_key = NULL WHERE guild_id = ? AND ign_key = ? AND user_id != ?', (guild_id, key, user_id))
+    await db.execute(
+        'INSERT INTO user_info (guild_id, user_id, ign, ign_key, region) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT(guild_id, user_id) DO UPDATE SET ign = excluded.ign, ign_key = excluded.ign_key, region = excluded.region',
+        (guild_id, user_id, ign, key, region)
+    )
+    return key
+
+def _cache_user_info(guild_id, user_id, ign, key, region):
+    previous_owner = user_cache.by_ign.get((guild_id, key))
+    if previous_owner not in (None, (guild_id, user_id)):
+        user_cache.update(previous_owner, ign_key=None)
+    user_cache.update((guild_id, user_id), ign=ign, ign_key=key, region=region)
+
+@timed('db')
+async def save_user_info(guild_id, user_id, ign, region):
+    async with database.writer() as db:
+        key = await _upsert_user_info(db, guild_id, user_id, ign, region)
+    _cache_user_info(guild_id, user_id, ign, key, region)
+
+@timed('db')
+async def verify_user_info(guild_id, user_id, ign, region, tested_after):
+    # Cooldown check and save in one transaction, so two submissions for the
+    # same IGN cannot both pass the check. Returns the last test timestamp if
+    # the IGN was tested after tested_after, otherwise saves and returns None.
+    async with database.writer() as db:
+        async with db.execute('SELECT last_test_timestamp FROM user_info WHERE guild_id = ? AND ign_key = ?', (guild_id, normalize_ign(ign))) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return {'ign': row[0], 'region': row[1], 'last_test_timestamp': row[2]}
-            return None
+        if row and row[0] and row[0] > tested_after:
+            return row[0]
+        key = await _upsert_user_info(db, guild_id, user_id, ign, region)
+    _cache_user_info(guild_id, user_id, ign, key, region)
+    return None
 
-async def get_user_info_by_ign(ign):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute('SELECT user_id, ign, region, last_test_timestamp FROM user_info WHERE ign = ?', (ign,)) as cursor:
+async def _load_user_info(guild_id, column, value):
+    writes = user_cache.writes
+    async with database.reader() as db:
+        async with db.execute(
+            f'SELECT user_id, ign, ign_key, region, last_test_timestamp FROM user_info WHERE guild_id = ? AND {column} = ?',
+            (guild_id, value)
+        ) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return {'user_id': row[0], 'ign': row[1], 'region': row[2], 'last_test_timestamp': row[3]}
-            return None
+    if row:
+        info = {'guild_id': guild_id, 'user_id': row[0], 'ign': row[1], 'ign_key': row[2], 'region': row[3], 'last_test_timestamp': row[4]}
+        user_cache.fill((guild_id, info['user_id']), info, writes)
+        return info
+    if column == 'user_id':
+        user_cache.fill((guild_id, value), None, writes)
+    return None
+
+@timed('db')
+async def get_user_info(guild_id, user_id):
+    info = user_cache.get((guild_id, user_id))
+    if info is MISSING:
+        info = await _load_user_info(guild_id, 'user_id', user_id)
+    if info:
+        return {'ign': info['ign'], 'region': info['region'], 'last_test_timestamp': info['last_test_timestamp']}
+    return None
+
+@timed('db')
+async def load_cooldowns():
+    async with database.reader() as db:
+        async with db.execute('SELECT guild_id, user_id, cooldown_until FROM user_info WHERE cooldown_until IS NOT NULL') as cursor:
+            return [(row[0], row[1], row[2]) async for row in cursor]
+
+@timed('db')
+async def backfill_cooldowns(default_interval):
+    # Players tested before cooldown_until existed, or imported with only a
+    # last_test_timestamp before imports filled it, have none and could
+    # rejoin straight away. Rows still inside their guild's test interval get
+    # one, once per database.
+    if await get_bot_state('cooldowns_backfilled'):
+        return 0
+    interval = "COALESCE((SELECT value * 86400 FROM guild_config WHERE guild_config.guild_id = user_info.guild_id AND key = 'test_interval_days'), ?)"
+    async with database.writer() as db:
+        cursor = await db.execute(
+            f'UPDATE user_info SET cooldown_until = last_test_timestamp + {interval} '
+            f'WHERE cooldown_until IS NULL AND last_test_timestamp IS NOT NULL AND last_test_timestamp + {interval} > ?',
+            (default_interval, default_interval, int(time.time()))
+        )
+        await db.execute("REPLACE INTO bot_state (key, value) VALUES ('cooldowns_backfilled', '1')")
+        return cursor.rowcount
+
+@timed('db')
+async def clear_cooldowns(expired):
+    # expired is [(guild_id, user_id, cooldown_until)]; users tested again since keep theirs.
+    async with database.writer() as db:
+        await db.executemany('UPDATE user_info SET cooldown_until = NULL WHERE guild_id = ? AND user_id = ? AND cooldown_until = ?', expired)
+
+tier_counts = {}
+
+def _count_tier(guild_id, key, delta):
+    counts = tier_counts.get(guild_id)
+    if counts is None or key is None:
+        return
+    counts[key] = counts.get(key, 0) + delta
+    if not counts[key]:
+        del counts[key]
+
+async def _record_results(db, guild_id, results):
+    # Returns [(old (tier, region) or None, new (tier, region))] per result.
+    replaced = []
+    for testee_id, tester_id, tier, tier_rank, region, tested_at in results:
+        async with db.execute('SELECT tier, region FROM player_tiers WHERE guild_id = ? AND user_id = ?', (guild_id, testee_id)) as cursor:
+            row = await cursor.fetchone()
+        replaced.append((tuple(row) if row else None, (tier, region)))
+    await db.executemany(
+        'INSERT INTO test_results (guild_id, testee_id, tester_id, tier, region, tested_at) VALUES (?, ?, ?, ?, ?, ?)',
+        [(guild_id, testee_id, tester_id, tier, region, tested_at) for testee_id, tester_id, tier, _, region, tested_at in results]
+    )
+    await db.executemany(
+        'REPLACE INTO player_tiers (guild_id, user_id, tier, tier_rank, region, tested_at) VALUES (?, ?, ?, ?, ?, ?)',
+        [(guild_id, testee_id, tier, tier_rank, region, tested_at) for testee_id, _, tier, tier_rank, region, tested_at in results]
+    )
+    return replaced
+
+@timed('db')
+async def get_tier_counts(guild_id):
+    # Players per (tier, region) by their latest result. Counted once per
+    # guild, then kept up to date as results are recorded.
+    if guild_id not in tier_counts:
+        async with database.reader() as db:
+            async with db.execute('SELECT tier, region, COUNT(*) FROM player_tiers WHERE guild_id = ? GROUP BY tier, region', (guild_id,)) as cursor:
+                counts = {(row[0], row[1]): row[2] async for row in cursor}
+        tier_counts.setdefault(guild_id, counts)
+    return dict(tier_counts[guild_id])
+
+@timed('db')
+async def get_current_tier(guild_id, user_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT tier FROM player_tiers WHERE guild_id = ? AND user_id = ?', (guild_id, user_id)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+@timed('db')
+async def count_user_results(guild_id, user_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT COUNT(*) FROM test_results WHERE guild_id = ? AND testee_id = ?', (guild_id, user_id)) as cursor:
+            return (await cursor.fetchone())[0]
+
+# Pages are keyset-paginated: each takes the key of the last row of the
+# previous page (None for the first) and seeks past it in the index, so a
+# deep page costs the same as the first one. Rows carry their 'key'.
+
+@timed('db')
+async def get_user_results(guild_id, user_id, after, limit):
+    query = 'SELECT id, tester_id, tier, region, tested_at FROM test_results WHERE guild_id = ? AND testee_id = ?'
+    params = (guild_id, user_id)
+    if after is not None:
+        query += ' AND id < ?'
+        params += (after,)
+    async with database.reader() as db:
+        async with db.execute(query + ' ORDER BY id DESC LIMIT ?', params + (limit,)) as cursor:
+            return [{'key': row[0], 'tester_id': row[1], 'tier': row[2], 'region': row[3], 'tested_at': row[4]} async for row in cursor]
+
+@timed('db')
+async def get_leaderboard(guild_id, region, after, limit):
+    # after is (tier_rank, tested_at, user_id). The order mixes a descending
+    # rank with ascending tiebreaks, which one row-value comparison cannot
+    # express, so the rest of the last row's rank is read first and then
+    # the ranks below it; both are range seeks on the index.
+    columns = 'SELECT user_id, tier, region, tested_at, tier_rank FROM player_tiers WHERE guild_id = ?'
+    params = (guild_id,)
+    if region:
+        columns += ' AND region = ?'
+        params += (region,)
+    queries = []
+    if after is None:
+        queries.append((columns + ' ORDER BY tier_rank DESC, tested_at, user_id LIMIT ?', params))
+    else:
+        tier_rank, tested_at, user_id = after
+        queries.append((columns + ' AND tier_rank = ? AND (tested_at, user_id) > (?, ?) ORDER BY tested_at, user_id LIMIT ?', params + (tier_rank, tested_at, user_id)))
+        queries.append((columns + ' AND tier_rank < ? ORDER BY tier_rank DESC, tested_at, user_id LIMIT ?', params + (tier_rank,)))
+    rows = []
+    async with database.reader() as db:
+        for query, query_params in queries:
+            async with db.execute(query, query_params + (limit - len(rows),)) as cursor:
+                rows.extend([{'user_id': row[0], 'tier': row[1], 'region': row[2], 'tested_at': row[3], 'key': (row[4], row[3], row[0])} async for row in cursor])
+            if len(rows) >= limit:
+                break
+    return rows
+
+@timed('db')
+async def get_tester_stats(guild_id, tester_id):
+    async with database.reader() as db:
+        async with db.execute('SELECT tier, COUNT(*) FROM test_results WHERE guild_id = ? AND tester_id = ? GROUP BY tier', (guild_id, tester_id)) as cursor:
+            by_tier = {row[0]: row[1] async for row in cursor}
+    return {'total': sum(by_tier.values()), 'by_tier': by_tier}
+
+@timed('db')
+async def import_user_info(guild_id, rows, test_interval):
+    # rows is [(user_id, ign, region, last_test_timestamp, cooldown_until)],
+    # written in one transaction. Later rows win, both for the same user and
+    # for an IGN claimed twice, as if they had verified in that order.
+    # Timestamps left empty keep what is already stored; a row with only a
+    # last test still inside test_interval gets the cooldown it implies.
+    owners = {}
+    records = []
+    now = int(time.time())
+    for user_id, ign, region, last_test_timestamp, cooldown_until in rows:
+        if cooldown_until is None and last_test_timestamp is not None and last_test_timestamp + test_interval > now:
+            cooldown_until = last_test_timestamp + test_interval
+        key = normalize_ign(ign)
+        previous = owners.get(key)
+        if previous is not None and previous[0] != user_id:
+            previous[2] = None
+        record = [user_id, ign, key, region, last_test_timestamp, cooldown_until]
+        owners[key] = record
+        records.append(record)
+    async with database.writer() as db:
+        await db.executemany(
+            'UPDATE user_info SET ign_key = NULL WHERE guild_id = ? AND ign_key = ? AND user_id != ?',
+            [(guild_id, key, user_id) for user_id, _, key, *_ in records if key is not None]
+        )
+        await db.executemany(
+            'INSERT INTO user_info (guild_id, user_id, ign, ign_key, region, last_test_timestamp, cooldown_until) VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(guild_id, user_id) DO UPDATE SET ign = excluded.ign, ign_key = excluded.ign_key, region = excluded.region, '
+            'last_test_timestamp = COALESCE(excluded.last_test_timestamp, last_test_timestamp), '
+            'cooldown_until = COALESCE(excluded.cooldown_until, cooldown_until)',
+            [(guild_id, *record) for record in records]
+        )
+    for user_id, ign, key, region, last_test_timestamp, _ in records:
+        _cache_user_info(guild_id, user_id, ign, key, region)
+        if last_test_timestamp is not None:
+            user_cache.update((guild_id, user_id), last_test_timestamp=last_test_timestamp)
+    return len(records)
+
+@timed('db')
+async def import_results(guild_id, results):
+    # results is [(testee_id, tester_id, tier, tier_rank, region, tested_at)],
+    # written in one transaction. A result already in the history is skipped,
+    # so importing the same file twice adds nothing. player_tiers only moves
+    # forward, to the newest result per player.
+    async with database.writer() as db:
+        before = db.total_changes
+        await db.executemany(
+            'INSERT INTO test_results (guild_id, testee_id, tester_id, tier, region, tested_at) SELECT ?, ?, ?, ?, ?, ? '
+            'WHERE NOT EXISTS (SELECT 1 FROM test_results WHERE guild_id = ? AND testee_id = ? AND tested_at = ? AND tester_id = ? AND tier = ?)',
+            [
+                (guild_id, testee_id, tester_id, tier, region, tested_at, guild_id, testee_id, tested_at, tester_id, tier)
+                for testee_id, tester_id, tier, _, region, tested_at in results
+            ]
+        )
+        inserted = db.total_changes - before
+        await db.executemany(
+            'INSERT INTO player_tiers (guild_id, user_id, tier, tier_rank, region, tested_at) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(guild_id, user_id) DO UPDATE SET tier = excluded.tier, tier_rank = excluded.tier_rank, '
+            'region = excluded.region, tested_at = excluded.tested_at WHERE excluded.tested_at >= player_tiers.tested_at',
+            [(guild_id, testee_id, tier, tier_rank, region, tested_at) for testee_id, _, tier, tier_rank, region, tested_at in results]
+        )
+    # Recounted on the next leaderboard instead of tracking each replacement.
+    tier_counts.pop(guild_id, None)
+    return inserted
+
+async def stream_user_info(guild_id, page_size):
+    # Pages by primary key, each page a short read of its own, so an export
+    # neither loads the table nor holds a reader for its whole length.
+    after = -1
+    while True:
+        async with database.reader() as db:
+            async with db.execute(
+                'SELECT user_id, ign, region, last_test_timestamp, cooldown_until FROM user_info '
+                'WHERE guild_id = ? AND user_id > ? ORDER BY user_id LIMIT ?',
+                (guild_id, after, page_size)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        for row in rows:
+            yield {'user_id': row[0], 'ign': row[1], 'region': row[2], 'last_test_timestamp': row[3], 'cooldown_until': row[4]}
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+async def stream_results(guild_id, page_size):
+    after = 0
+    while True:
+        async with database.reader() as db:
+            async with db.execute(
+                'SELECT id, testee_id, tester_id, tier, region, tested_at FROM test_results WHERE guild_id = ? AND id > ? ORDER BY id LIMIT ?',
+                (guild_id, after, page_size)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        for row in rows:
+            yield {'testee_id': row[1], 'tester_id': row[2], 'tier': row[3], 'region': row[4], 'tested_at': row[5]}
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
 
-async def set_last_test_timestamp(user_id, timestamp):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('UPDATE user_info SET last_test_timestamp = ? WHERE user_id = ?', (timestamp, user_id))
-        await db.commit()
+@timed('db')
+async def get_current_tiers(guild_id, user_ids):
+    if not user_ids:
+        return {}
+    async with database.reader() as db:
+        async with db.execute(
+            f'SELECT user_id, tier FROM player_tiers WHERE guild_id = ? AND user_id IN ({", ".join("?" * len(user_ids))})',
+            (guild_id, *user_ids)
+        ) as cursor:
+            return {row[0]: row[1] async for row in cursor}
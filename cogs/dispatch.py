@@ -0,0 +1,233 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import Counter
+import discord
+from .metrics import metrics
+
+API_WORKERS = int(os.getenv('API_WORKERS', 8))
+API_BACKLOG = int(os.getenv('API_BACKLOG', 500))
+API_ROUTE_CONCURRENCY = int(os.getenv('API_ROUTE_CONCURRENCY', 2))
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', 3))
+API_DRAIN_SECONDS = float(os.getenv('API_DRAIN_SECONDS', 10))
+
+# Lower runs first. Critical is what a user is waiting on right now, like the
+# ticket for the next testee; low is cosmetic, like queue embed edits.
+CRITICAL = 0
+NORMAL = 1
+LOW = 2
+
+class BacklogFull(Exception):
+    pass
+
+def route_name(route):
+    return route[0] if isinstance(route, tuple) else route
+
+class ApiCall:
+    def __init__(self, call, priority, route, key, seq):
+        self.call = call
+        self.priority = priority
+        self.route = route
+        self.key = key
+        self.seq = seq
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.queued_at = time.perf_counter()
+        self.attempts = 0
+        self.dropped = False
+
+    def entry(self):
+        return (self.priority, self.seq, self)
+
+    def finish(self, result):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def fail(self, error):
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+class ApiDispatcher:
+    # Every outbound REST call the cogs make goes through here instead of being
+    # awaited inline. Calls run on a fixed pool of workers in priority order,
+    # with at most a few in flight per route (a route is a name plus the
+    # channel or guild it hits, like Discord's own buckets). A call submitted
+    # with a key replaces a queued call with the same key, whose waiters get
+    # the newer call's result. discord.py sleeps through short rate limits
+    # inside the call itself; one longer than the bot's max_ratelimit_timeout
+    # comes back as RateLimited, which pauses the route and retries the call.
+    # The backlog is bounded: when it is full, a new call evicts the least
+    # important queued one, or is refused if nothing queued is less important.
+    def __init__(self, workers=API_WORKERS, backlog=API_BACKLOG, route_concurrency=API_ROUTE_CONCURRENCY):
+        self.worker_count = max(1, workers)
+        self.backlog = max(1, backlog)
+        self.route_concurrency = max(1, route_concurrency)
+        self.limits = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.queued = 0
+        self.by_key = {}
+        self.active = Counter()
+        self.parked = {}
+        self.paused = {}
+        self.wake = asyncio.Event()
+        self.workers = []
+        self.owners = set()
+
+    def set_limit(self, name, concurrency):
+        self.limits[name] = max(1, concurrency)
+
+    def limit(self, route):
+        return self.limits.get(route_name(route), self.route_concurrency)
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.worker_count)]
+
+    async def open(self, owner=None):
+        if owner is not None:
+            self.owners.add(owner)
+        self.start()
+
+    async def close(self, owner=None):
+        # Like the database, the last cog to unload stops it, after giving
+        # queued calls up to API_DRAIN_SECONDS to finish.
+        self.owners.discard(owner)
+        if self.owners or not self.workers:
+            return
+        deadline = time.monotonic() + API_DRAIN_SECONDS
+        while (self.queued or sum(self.active.values())) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for job in [entry[2] for entry in self.heap] + [job for jobs in self.parked.values() for job in jobs]:
+            job.cancel()
+        self.heap = []
+        self.parked = {}
+        self.by_key = {}
+        self.queued = 0
+
+    def submit(self, call, priority=NORMAL, route='default', key=None):
+        # call is a function returning a fresh awaitable, so it can be retried.
+        # Returns a future for its result.
+        self.start()
+        job = ApiCall(call, priority, route, key, next(self.seq))
+        old = self.by_key.get(key) if key is not None else None
+        if old is not None and not old.dropped:
+            old.dropped = True
+            job.futures.extend(old.futures)
+            metrics.count('api_superseded', route_name(route))
+        else:
+            if self.queued >= self.backlog and not self.evict(priority):
+                metrics.count('api_rejected', route_name(route))
+                job.fail(BacklogFull(f'{self.queued} Discord API calls already queued'))
+                return job.futures[0]
+            self.queued += 1
+        if key is not None:
+            self.by_key[key] = job
+        heapq.heappush(self.heap, job.entry())
+        self.wake.set()
+        return job.futures[0]
+
+    def evict(self, priority):
+        queued = [entry[2] for entry in self.heap] + [job for jobs in self.parked.values() for job in jobs]
+        victims = [job for job in queued if not job.dropped and job.priority > priority]
+        if not victims:
+            return False
+        victim = max(victims, key=lambda job: (job.priority, job.seq))
+        self.drop(victim)
+        metrics.count('api_rejected', route_name(victim.route))
+        victim.fail(BacklogFull('Evicted by a more important Discord API call'))
+        return True
+
+    def drop(self, job):
+        job.dropped = True
+        self.unqueue(job)
+
+    def unqueue(self, job):
+        self.queued -= 1
+        if job.key is not None and self.by_key.get(job.key) is job:
+            del self.by_key[job.key]
+
+    def pop_ready(self):
+        while self.heap:
+            job = heapq.heappop(self.heap)[2]
+            if job.dropped:
+                continue
+            if self.paused.get(job.route, 0) > time.monotonic() or self.active[job.route] >= self.limit(job.route):
+                self.parked.setdefault(job.route, []).append(job)
+                continue
+            self.unqueue(job)
+            self.active[job.route] += 1
+            return job
+        return None
+
+    def unpark(self, route):
+        if self.paused.get(route, 0) <= time.monotonic():
+            self.paused.pop(route, None)
+        for job in self.parked.pop(route, []):
+            heapq.heappush(self.heap, job.entry())
+        self.wake.set()
+
+    async def next_job(self):
+        while True:
+            job = self.pop_ready()
+            if job:
+                return job
+            self.wake.clear()
+            await self.wake.wait()
+
+    def backoff(self, job, retry_after, error):
+        # The whole route waits out the rate limit, then the call is queued again.
+        self.paused[job.route] = time.monotonic() + retry_after
+        asyncio.get_running_loop().call_later(retry_after, self.unpark, job.route)
+        metrics.count('api_retries', route_name(job.route))
+        if job.attempts >= API_MAX_RETRIES:
+            job.fail(error)
+            return
+        job.attempts += 1
+        newer = self.by_key.get(job.key) if job.key is not None else None
+        if newer is not None:
+            newer.futures.extend(job.futures)
+            return
+        if job.key is not None:
+            self.by_key[job.key] = job
+        self.queued += 1
+        self.parked.setdefault(job.route, []).append(job)
+
+    async def work(self):
+        while True:
+            job = await self.next_job()
+            metrics.observe('dispatch', route_name(job.route), time.perf_counter() - job.queued_at)
+            try:
+                result = await job.call()
+            except asyncio.CancelledError:
+                job.cancel()
+                raise
+            except discord.RateLimited as e:
+                self.backoff(job, e.retry_after, e)
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.backoff(job, getattr(e, 'retry_after', 0) or 5, e)
+                else:
+                    job.fail(e)
+            except Exception as e:
+                job.fail(e)
+            else:
+                job.finish(result)
+            finally:
+                self.active[job.route] -= 1
+                if not self.active[job.route]:
+                    del self.active[job.route]
+                self.unpark(job.route)
+
+dispatcher = ApiDispatcher()
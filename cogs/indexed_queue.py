@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from itertools import islice
+
+class IndexedQueue:
+    # FIFO of user ids backed by an OrderedDict, giving O(1) membership,
+    # append, removal by user and head pop. Every entry keeps the sequence
+    # number it was appended with, which is what gets persisted as
+    # queue_members.position. `version` increases on every mutation so
+    # renderers and persistence can skip work when nothing changed.
+    def __init__(self, members=()):
+        self.entries = OrderedDict()
+        self.next_seq = 1
+        self.version = 0
+        self.ranks = None
+        self.ranks_version = -1
+        for user_id in members:
+            self.append(user_id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def items(self):
+        return self.entries.items()
+
+    def append(self, user_id):
+        if user_id in self.entries:
+            raise ValueError(f'{user_id} is already queued')
+        seq = self.next_seq
+        self.entries[user_id] = seq
+        self.next_seq += 1
+        self.version += 1
+        return seq
+
+    def appendleft(self, user_id):
+        # Puts someone back at the head, with a sequence before everyone else's.
+        if user_id in self.entries:
+            raise ValueError(f'{user_id} is already queued')
+        head = self.peek()
+        seq = (self.entries[head] if head is not None else self.next_seq) - 1
+        self.entries[user_id] = seq
+        self.entries.move_to_end(user_id, last=False)
+        self.version += 1
+        return seq
+
+    def remove(self, user_id):
+        seq = self.entries.pop(user_id)
+        self.version += 1
+        return seq
+
+    def popleft(self):
+        user_id, _ = self.entries.popitem(last=False)
+        self.version += 1
+        return user_id
+
+    def peek(self):
+        return next(iter(self.entries), None)
+
+    def clear(self):
+        if self.entries:
+            self.entries.clear()
+            self.version += 1
+
+    def compact(self):
+        # Renumber sequences 1..n, used before writing a full snapshot.
+        self.entries = OrderedDict((user_id, i + 1) for i, user_id in enumerate(self.entries))
+        self.next_seq = len(self.entries) + 1
+        self.version += 1
+
+    def position(self, user_id):
+        # 1-based position, or None. The rank index is rebuilt at most once per
+        # version, so repeated lookups between mutations are O(1).
+        if user_id not in self.entries:
+            return None
+        if self.ranks_version != self.version:
+            self.ranks = {uid: i + 1 for i, uid in enumerate(self.entries)}
+            self.ranks_version = self.version
+        return self.ranks[user_id]
+
+    def page(self, start, count):
+        return list(islice(self.entries, start, start + count))
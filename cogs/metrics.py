@@ -0,0 +1,127 @@
+import os
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+import discord
+
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', 1000))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Histogram kind -> (Prometheus metric name, label name).
+KINDS = {
+    'command': ('aurora_command_seconds', 'command'),
+    'db': ('aurora_db_seconds', 'query'),
+    'discord': ('aurora_discord_seconds', 'route'),
+    'dispatch': ('aurora_dispatch_wait_seconds', 'route'),
+}
+# Counter -> label name, for counters that have one.
+COUNTER_LABELS = {
+    'command_errors': 'command',
+    'commands_rejected': 'command',
+    'discord_errors': 'status',
+    'rate_limit_hits': 'scope',
+    'api_superseded': 'route',
+    'api_rejected': 'route',
+    'api_retries': 'route',
+}
+
+class Histogram:
+    # Cumulative buckets for Prometheus, plus the last METRICS_WINDOW samples
+    # for percentiles that follow current load rather than all time.
+    def __init__(self, window=METRICS_WINDOW):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, pct):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.started_at = time.time()
+
+    def observe(self, kind, label, seconds):
+        histogram = self.histograms.get((kind, label))
+        if histogram is None:
+            histogram = self.histograms[(kind, label)] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, label='', value=1):
+        self.counters[(name, label)] += value
+
+    @contextmanager
+    def timer(self, kind, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, label, time.perf_counter() - start)
+
+    def of_kind(self, kind):
+        return {label: histogram for (k, label), histogram in self.histograms.items() if k == kind}
+
+    def render(self):
+        lines = []
+        for kind, (name, label_name) in KINDS.items():
+            histograms = self.of_kind(kind)
+            if not histograms:
+                continue
+            lines.append(f'# TYPE {name} histogram')
+            for label, histogram in sorted(histograms.items()):
+                label = f'{label_name}="{escape(label)}"'
+                total = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    total += count
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {total}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{{label}}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{{label}}} {histogram.count}')
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE aurora_{name}_total counter')
+            for (counter, label), value in sorted(self.counters.items()):
+                if counter == name:
+                    label = f'{{{COUNTER_LABELS.get(name, "label")}="{escape(label)}"}}' if label else ''
+                    lines.append(f'aurora_{name}_total{label} {value}')
+        lines.append('# TYPE aurora_uptime_seconds gauge')
+        lines.append(f'aurora_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def interaction_name(interaction):
+    command = getattr(interaction, 'command', None)
+    if command is not None:
+        return command.qualified_name
+    data = getattr(interaction, 'data', None) or {}
+    return data.get('custom_id') or 'unknown'
+
+def since_created(interaction):
+    # From when Discord created the interaction, so it is the wait the user saw.
+    return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+def timed(kind):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(kind, func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+metrics = Metrics()
@@ -0,0 +1,83 @@
+import asyncio
+import os
+from collections import deque
+import discord
+from .metrics import metrics, interaction_name, since_created
+
+COMMAND_WORKERS = int(os.getenv('COMMAND_WORKERS', 4))
+COMMAND_BACKLOG = int(os.getenv('COMMAND_BACKLOG', 1000))
+
+class CommandPipeline:
+    # Interactions are acknowledged as soon as they arrive so Discord's
+    # 3-second deadline is never at risk. The slow part of the command runs on
+    # a bounded pool of workers and its return value is sent as a followup.
+    # Each guild has its own backlog and the workers take jobs from the guilds
+    # in turn, so a busy guild cannot fill the pipeline for everyone else or
+    # make their commands wait behind its whole backlog.
+    def __init__(self, workers=COMMAND_WORKERS, backlog=COMMAND_BACKLOG):
+        self.worker_count = max(1, workers)
+        self.backlog = max(1, backlog)
+        self.pending = {}
+        self.ready = deque()
+        self.wake = asyncio.Event()
+        self.workers = []
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def submit(self, interaction, job):
+        # The command's latency is recorded when its followup goes out.
+        interaction.extras['pipelined'] = True
+        if not interaction.response.is_done():
+            await interaction.response.defer(ephemeral=True, thinking=True)
+        guild_id = interaction.guild_id
+        jobs = self.pending.setdefault(guild_id, deque())
+        if len(jobs) >= self.backlog:
+            metrics.count('commands_rejected', interaction_name(interaction))
+            await self.reply(interaction, 'The bot is busy right now, please try again in a moment.')
+            return
+        if not jobs:
+            self.ready.append(guild_id)
+            self.wake.set()
+        jobs.append((interaction, job))
+
+    async def next_job(self):
+        while not self.ready:
+            self.wake.clear()
+            await self.wake.wait()
+        guild_id = self.ready.popleft()
+        jobs = self.pending[guild_id]
+        if len(jobs) > 1:
+            self.ready.append(guild_id)
+        else:
+            del self.pending[guild_id]
+        return jobs.popleft()
+
+    async def reply(self, interaction, message):
+        try:
+            await interaction.followup.send(message, ephemeral=True)
+        except discord.HTTPException as e:
+            print(f'Failed to send followup: {e}')
+
+    async def work(self):
+        while True:
+            interaction, job = await self.next_job()
+            name = interaction_name(interaction)
+            try:
+                message = await job()
+            except Exception as e:
+                print(f'Command failed: {e}')
+                metrics.count('command_errors', name)
+                message = 'Something went wrong, please try again.'
+            try:
+                if message:
+                    await self.reply(interaction, message)
+            finally:
+                metrics.observe('command', name, since_created(interaction))
@@ -5,28 +5,25 @@ import os
 from dotenv import load_dotenv
 import asyncio
 from . import db as queuedb
-from .verify import TEST_INTERVAL_DAYS
+from .refresher import EmbedRefresher
+from .pipeline import CommandPipeline
+from .indexed_queue import IndexedQueue
+from .tickets import TicketPool
+from .roles import reconciler
+from .cooldowns import CooldownScheduler
+from .config import guild_configs, tester_only, QUEUE_REGIONS, TIERS, TEST_INTERVAL_DAYS
+from .startup import phase
+from .dispatch import dispatcher, NORMAL, LOW
 import time
 
 load_dotenv()
-QUEUE_CHANNEL_ID = int(os.getenv('QUEUE_CHANNEL_ID', 0))
-TIER_ANNOUNCE_CHANNEL_ID = int(os.getenv('TIER_ANNOUNCE_CHANNEL_ID', 0))
-TESTER_ROLE_ID = int(os.getenv('TESTER_ROLE_ID', 0))
-WAITLIST_ROLE_ID = int(os.getenv('WAITLIST_ROLE_ID', 0))
-QUEUE_MAX = 20
-TIERS = ['LT5', 'HT5', 'LT4', 'HT4', 'LT3', 'HT3', 'LT2', 'HT2', 'LT1', 'HT1']
-TIER_ROLE_IDS = {
-    'LT5': 0,  #Add role ids where 0 goes
-    'HT5': 0,
-    'LT4': 0,
-    'HT4': 0,
-    'LT3': 0,
-    'HT3': 0,
-    'LT2': 0,
-    'HT2': 0,
-    'LT1': 0,
-    'HT1': 0
-}
+COOLDOWN_DM = os.getenv('COOLDOWN_DM', '0') == '1'
+# A page is one embed field, which Discord caps at 1024 characters; 30 lines
+# of "position. <@id>" fit.
+QUEUE_PAGE_SIZE = max(1, min(int(os.getenv('QUEUE_PAGE_SIZE', 20)), 30))
+QUEUE_REFRESH_SECONDS = float(os.getenv('QUEUE_REFRESH_SECONDS', 2))
+QUEUE_COMPACT_SECONDS = float(os.getenv('QUEUE_COMPACT_SECONDS', 300))
+REGION_CHOICES = [app_commands.Choice(name=r, value=r) for r in QUEUE_REGIONS]
 
 class QueueView(ui.View):
     def __init__(self, cog):
@@ -37,265 +34,716 @@ class QueueView(ui.View):
     async def join_queue(self, interaction: Interaction, button: ui.Button):
         await self.cog.handle_join_queue(interaction)
 
-class QueueCog(commands.Cog):
-    def __init__(self, bot):
-        self.bot = bot
-        self.queue_open = False
-        self.queue = []
-        self.active_testers = set()
-        self.current_ticket = None
-        self.current_testee = None
-        self.previous_tier = None
-        self.last_testee = None
-        self.queue_message = None
+    @ui.button(label='My Position', style=discord.ButtonStyle.gray, custom_id='queue_position_btn')
+    async def my_position(self, interaction: Interaction, button: ui.Button):
+        await self.cog.handle_position(interaction)
 
-    async def cog_load(self):
-        await queuedb.init_db()
-        state = await queuedb.load_queue_state()
-        if state:
-            self.queue_open = state['queue_open']
-            self.current_testee = state['current_testee']
-            self.previous_tier = state['previous_tier']
-            self.queue_message = None
-            self.queue = await queuedb.load_queue_members()
-            self.active_testers = set(await queuedb.load_active_testers())
-            if state['queue_message_id'] and state['queue_channel_id']:
-                channel = self.bot.get_channel(state['queue_channel_id'])
-                if channel:
-                    try:
-                        self.queue_message = await channel.fetch_message(state['queue_message_id'])
-                    except Exception:
-                        self.queue_message = None
-            await self.update_queue_message()
-        else:
-            await queuedb.save_queue_state(self.queue_open, None, QUEUE_CHANNEL_ID, self.current_testee, self.previous_tier)
-            await queuedb.save_queue_members(self.queue)
-            await queuedb.save_active_testers(list(self.active_testers))
+class QueuePageView(ui.View):
+    def __init__(self, shard, page=0):
+        super().__init__(timeout=300)
+        self.shard = shard
+        self.page = page
 
-    async def update_queue_message(self):
-        channel = self.bot.get_channel(QUEUE_CHANNEL_ID)
-        if not channel:
-            return
+    async def show(self, interaction, page):
+        self.page = max(0, min(page, self.shard.page_count() - 1))
+        await interaction.response.edit_message(embed=self.shard.embed(self.page), view=self)
+
+    @ui.button(label='Previous', style=discord.ButtonStyle.gray)
+    async def previous_page(self, interaction: Interaction, button: ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @ui.button(label='Next', style=discord.ButtonStyle.gray)
+    async def next_page(self, interaction: Interaction, button: ui.Button):
+        await self.show(interaction, self.page + 1)
+
+    @ui.button(label='My Position', style=discord.ButtonStyle.blurple)
+    async def my_position(self, interaction: Interaction, button: ui.Button):
+        position = self.shard.queue.position(interaction.user.id)
+        page = (position - 1) // QUEUE_PAGE_SIZE if position else self.page
+        await self.show(interaction, page)
+
+class TestSession:
+    # One tester's test in progress: who they are testing and the ticket for it.
+    def __init__(self, tester_id, testee_id=None, ticket_channel_id=None, started_at=None):
+        self.tester_id = tester_id
+        self.testee_id = testee_id
+        self.ticket_channel_id = ticket_channel_id
+        self.started_at = started_at
+
+    def row(self):
+        return (self.tester_id, self.testee_id, self.ticket_channel_id, self.started_at)
+
+class QueueShard:
+    # One regional queue with its own size limit and persistent embed.
+    def __init__(self, owner, region):
+        self.owner = owner
+        self.region = region
+        self.queue = IndexedQueue()
+        self.message = None
+        self.message_id = None
+        self.rendered_key = None
+        self.page_cache = {}
+        self.page_cache_key = None
+        self.refresher = EmbedRefresher(self.refresh_message, QUEUE_REFRESH_SECONDS)
+
+    @property
+    def max_size(self):
+        return self.owner.config.queue_max(self.region)
+
+    @property
+    def channel_id(self):
+        return self.owner.config.queue_channel_id(self.region)
+
+    def row(self):
+        return (self.region, self.channel_id, self.message.id if self.message else self.message_id)
+
+    def testers(self):
+        # Testers without a region pull from every shard, so they show on all of them.
+        return frozenset(tid for tid, region in self.owner.active_testers.items() if region in (self.region, None))
+
+    def render_key(self):
+        return (self.queue.version, self.testers(), self.max_size)
+
+    def page_count(self):
+        return max(1, -(-len(self.queue) // QUEUE_PAGE_SIZE))
+
+    def embed(self, page, summary=False):
+        # Pages are rendered once per queue version and tester set, so paging
+        # through a large queue, or many users opening /queue, reuses them.
+        page = max(0, min(page, self.page_count() - 1))
+        testers = self.testers()
+        key = self.render_key()
+        if key != self.page_cache_key:
+            self.page_cache = {}
+            self.page_cache_key = key
+        if (page, summary) in self.page_cache:
+            return self.page_cache[(page, summary)]
+        pages = self.page_count()
+        start = page * QUEUE_PAGE_SIZE
         embed = discord.Embed(
-            title=f"Aurora Queue ({len(self.queue)}/{QUEUE_MAX})",
+            title=f"Aurora {self.region} Queue ({len(self.queue)}/{self.max_size})",
             color=discord.Color.blue()
         )
+        if summary and len(self.queue) > QUEUE_PAGE_SIZE:
+            embed.description = f"Showing the first {QUEUE_PAGE_SIZE} of {len(self.queue)}. Use /queue to see everyone or /position to find your spot."
         if self.queue:
             embed.add_field(
                 name="Queue",
-                value="\n".join([f"{i+1}. <@{user_id}>" for i, user_id in enumerate(self.queue)]),
+                value="\n".join([f"{start+i+1}. <@{user_id}>" for i, user_id in enumerate(self.queue.page(start, QUEUE_PAGE_SIZE))]),
                 inline=False
             )
         else:
             embed.add_field(name="Queue", value="No one in queue.", inline=False)
-        if self.active_testers:
-            tester_mentions = [f"<@{tid}>" for tid in self.active_testers]
+        if testers:
+            tester_mentions = [f"<@{tid}>" for tid in testers]
             embed.add_field(name="Active Testers", value=", ".join(tester_mentions), inline=False)
         else:
             embed.add_field(name="Active Testers", value="None", inline=False)
-        embed.set_footer(text="Use /leave to leave the queue.")
-        if not self.queue_message:
-            self.queue_message = await channel.send(embed=embed, view=QueueView(self))
+        if summary or pages == 1:
+            embed.set_footer(text="Use /leave to leave the queue.")
         else:
-            await self.queue_message.edit(embed=embed, view=QueueView(self))
-        await queuedb.save_queue_state(
-            self.queue_open,
-            self.queue_message.id if self.queue_message else None,
-            QUEUE_CHANNEL_ID,
-            self.current_testee,
-            self.previous_tier
-        )
-        await queuedb.save_queue_members(self.queue)
-        await queuedb.save_active_testers(list(self.active_testers))
+            embed.set_footer(text=f"Page {page+1}/{pages} · Use /leave to leave the queue.")
+        self.page_cache[(page, summary)] = embed
+        return embed
 
-    @app_commands.command(name='start', description='Open the queue for people to join')
-    @app_commands.checks.has_role(TESTER_ROLE_ID)
-    async def start(self, interaction: Interaction):
-        if self.queue_open:
-            await interaction.response.send_message('Queue is already open.', ephemeral=True)
+    async def refresh_message(self):
+        if not self.owner.bot.is_ready():
+            return
+        channel = self.owner.bot.get_channel(self.channel_id)
+        if not channel:
+            return
+        route = ('queue_embed', channel.id)
+        restored = False
+        if self.message is None and self.message_id:
+            # The message from before a restart is only fetched once the
+            # gateway is ready, on the first refresh after it.
+            message_id = self.message_id
+            try:
+                self.message = await dispatcher.submit(lambda: channel.fetch_message(message_id), LOW, route)
+                restored = True
+            except (discord.NotFound, discord.Forbidden):
+                pass
+            self.message_id = None
+        key = self.render_key()
+        if self.message and key == self.rendered_key:
+            return
+        embed = self.embed(0, summary=True)
+        if self.message:
+            message = self.message
+            # A message posted by an older version may lack some of the
+            # view's buttons, so the first edit after a restart sends it too.
+            changes = {'embed': embed, 'view': self.owner.cog.view} if restored else {'embed': embed}
+            try:
+                # A newer render of this shard replaces one still waiting to be sent.
+                await dispatcher.submit(lambda: message.edit(**changes), LOW, route, key=('queue_embed', self.owner.guild_id, self.region))
+                self.rendered_key = key
+                return
+            except discord.NotFound:
+                self.message = None
+        view = self.owner.cog.view
+        self.message = await dispatcher.submit(lambda: channel.send(embed=embed, view=view), LOW, route)
+        self.rendered_key = key
+        # Under the guild lock, so a command paused between its changes is
+        # not persisted halfway.
+        async with self.owner.lock:
+            self.owner.changes.set_shard(*self.row())
+            await self.owner.persist()
+
+class GuildQueue:
+    # Everything the queue keeps for one guild: its regional shards, testers,
+    # sessions, pending changes and ticket pool, guarded by its own lock so a
+    # busy guild never holds up another.
+    def __init__(self, cog, guild_id):
+        self.cog = cog
+        self.bot = cog.bot
+        self.guild_id = guild_id
+        self.config = guild_configs.get(guild_id)
+        self.queue_open = False
+        self.shards = {region: QueueShard(self, region) for region in QUEUE_REGIONS}
+        self.active_testers = {}
+        self.sessions = {}
+        self.changes = queuedb.QueueChanges(guild_id)
+        self.persisted_state = None
+        self.tickets = TicketPool(cog.bot, self.config)
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        for shard in self.shards.values():
+            shard.refresher.start()
+        self.tickets.start()
+
+    async def stop(self):
+        await self.tickets.stop()
+        for shard in self.shards.values():
+            await shard.refresher.stop()
+        await self.persist()
+
+    async def restore(self):
+        state = await queuedb.load_queue_state(self.guild_id)
+        if not state:
+            await self.save_snapshot()
+            return
+        self.queue_open = state['queue_open']
+        for user_id, region in await queuedb.load_queue_members(self.guild_id):
+            shard = self.shard_for(region)
+            if user_id not in shard.queue:
+                shard.queue.append(user_id)
+        self.active_testers = {
+            tester_id: region if region in self.shards else None
+            for tester_id, region in (await queuedb.load_active_testers(self.guild_id)).items()
+        }
+        self.sessions = {row['tester_id']: TestSession(**row) for row in await queuedb.load_test_sessions(self.guild_id)}
+        messages = await queuedb.load_queue_shards(self.guild_id)
+        if not messages and state['queue_message_id']:
+            # Databases from before regional queues had one message in queue_state.
+            messages = {QUEUE_REGIONS[0]: {'channel_id': state['queue_channel_id'], 'message_id': state['queue_message_id']}}
+        for region, row in messages.items():
+            if region in self.shards and row['channel_id'] == self.shards[region].channel_id:
+                self.shards[region].message_id = row['message_id']
+        await self.save_snapshot()
+
+    def mark_dirty(self):
+        for shard in self.shards.values():
+            shard.refresher.mark_dirty()
+
+    def shard_for(self, region):
+        region = (region or '').upper()
+        return self.shards.get(region) or self.shards[QUEUE_REGIONS[0]]
+
+    def shard_of(self, user_id):
+        for shard in self.shards.values():
+            if user_id in shard.queue:
+                return shard
+        return None
+
+    def queue_state(self):
+        return (self.queue_open,)
+
+    async def save_snapshot(self):
+        state = self.queue_state()
+        members = []
+        for shard in self.shards.values():
+            shard.queue.compact()
+            members.extend((user_id, position, shard.region) for user_id, position in shard.queue.items())
+        sessions = [session.row() for session in self.sessions.values()]
+        shards = [shard.row() for shard in self.shards.values()]
+        # Changes recorded while the snapshot is written are not in it.
+        self.changes = queuedb.QueueChanges(self.guild_id)
+        await queuedb.save_queue_snapshot(self.guild_id, *state, members, list(self.active_testers.items()), sessions, shards)
+        self.persisted_state = state
+
+    async def persist(self):
+        state = self.queue_state()
+        if state != self.persisted_state:
+            self.changes.set_state(*state)
+        changes, self.changes = self.changes, queuedb.QueueChanges(self.guild_id)
+        await queuedb.apply_queue_changes(changes)
+        self.persisted_state = state
+
+    def enqueue(self, shard, user_id):
+        position = shard.queue.append(user_id)
+        self.changes.join(user_id, position, shard.region)
+
+    def requeue(self, shard, user_id):
+        position = shard.queue.appendleft(user_id)
+        self.changes.join(user_id, position, shard.region)
+
+    def dequeue(self, shard, user_id=None):
+        if user_id is None:
+            user_id = shard.queue.popleft()
+            self.changes.pop(user_id)
+        else:
+            shard.queue.remove(user_id)
+            self.changes.leave(user_id)
+        return user_id
+
+    def add_tester(self, user_id, region):
+        self.active_testers[user_id] = region
+        self.changes.add_tester(user_id, region)
+
+    def remove_tester(self, user_id):
+        self.active_testers.pop(user_id, None)
+        self.changes.remove_tester(user_id)
+
+    def save_session(self, session):
+        self.sessions[session.tester_id] = session
+        self.changes.save_session(*session.row())
+
+    def end_session(self, tester_id):
+        session = self.sessions.pop(tester_id, None)
+        if session:
+            self.changes.end_session(tester_id)
+        return session
+
+    async def update_queue_message(self):
+        # Shards whose queue and testers are unchanged skip the edit on their own.
+        await self.persist()
+        self.mark_dirty()
+
+    def testing(self, user_id):
+        return any(session.testee_id == user_id for session in self.sessions.values())
+
+    def pick_shard(self, tester_id):
+        # A tester's own region first; otherwise the longest other queue.
+        own = self.shards.get(self.active_testers.get(tester_id))
+        if own and own.queue:
+            return own
+        waiting = [shard for shard in self.shards.values() if shard.queue]
+        return max(waiting, key=lambda shard: len(shard.queue), default=None)
+
+    def advance_session(self, tester_id):
+        # Must be called with self.lock held. Pulls the next person into this
+        # tester's session from their region's queue; returns them, if any.
+        shard = self.pick_shard(tester_id)
+        if not shard:
+            self.end_session(tester_id)
+            return None
+        session = TestSession(tester_id, testee_id=self.dequeue(shard), started_at=int(time.time()))
+        self.save_session(session)
+        return session.testee_id
+
+class QueueCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.guild_queues = {}
+        self.view = None
+        self.pipeline = CommandPipeline()
+        self.reporters = set()
+        self.cooldowns = CooldownScheduler(self.lift_cooldowns)
+        self.compactor = None
+
+    async def cog_load(self):
+        await queuedb.open_db(self)
+        await dispatcher.open(self)
+        with phase('database schema'):
+            await queuedb.init_db()
+        with phase('guild configs'):
+            await guild_configs.load()
+        # The queue tables hold the last snapshot; events logged after it are
+        # replayed into them before anything is read.
+        with phase('queue event replay'):
+            replayed = await queuedb.compact_queue_events()
+        if replayed:
+            print(f'Replayed {replayed} queue event(s) since the last snapshot.')
+        if self.compactor is None or self.compactor.done():
+            self.compactor = asyncio.create_task(self.compact_events())
+        if self.view is None:
+            self.view = QueueView(self)
+            self.bot.add_view(self.view)
+        self.pipeline.start()
+        with phase('cooldowns'):
+            backfilled = await queuedb.backfill_cooldowns(TEST_INTERVAL_DAYS * 86400)
+            if backfilled:
+                print(f'Set cooldowns for {backfilled} player(s) tested before cooldowns were stored.')
+            for guild_id, user_id, until in await queuedb.load_cooldowns():
+                self.cooldowns.schedule((guild_id, user_id), until)
+        self.cooldowns.start()
+        guild_ids = await queuedb.load_guild_ids()
+        with phase(f'queue restore ({len(guild_ids)} guild(s))'):
+            for guild_id in guild_ids:
+                await self.queue_for(guild_id).restore()
+
+    @commands.Cog.listener()
+    async def on_user_info_import(self, guild_id):
+        # Imported rows can carry cooldowns the scheduler has not seen.
+        for cooldown_guild_id, user_id, until in await queuedb.load_cooldowns():
+            if cooldown_guild_id == guild_id:
+                self.cooldowns.schedule((guild_id, user_id), until)
+
+    async def cog_unload(self):
+        await self.pipeline.stop()
+        await asyncio.gather(*self.reporters, return_exceptions=True)
+        await self.cooldowns.stop()
+        if self.compactor:
+            self.compactor.cancel()
+            await asyncio.gather(self.compactor, return_exceptions=True)
+            self.compactor = None
+        for guild_queue in self.guild_queues.values():
+            await guild_queue.stop()
+        await queuedb.compact_queue_events()
+        await dispatcher.close(self)
+        await queuedb.close_db(self)
+
+    def queue_for(self, guild_id):
+        guild_queue = self.guild_queues.get(guild_id)
+        if guild_queue is None:
+            guild_queue = self.guild_queues[guild_id] = GuildQueue(self, guild_id)
+            guild_queue.start()
+        return guild_queue
+
+    async def compact_events(self):
+        while True:
+            await asyncio.sleep(QUEUE_COMPACT_SECONDS)
+            try:
+                await queuedb.compact_queue_events()
+            except Exception as e:
+                print(f'Failed to compact queue events: {e}')
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Queue messages are fetched and brought up to date once the gateway
+        # is ready; after a reconnect this only edits what actually changed.
+        for guild_queue in self.guild_queues.values():
+            guild_queue.mark_dirty()
+
+    @commands.Cog.listener()
+    async def on_guild_config_update(self, guild_id, setting):
+        guild_queue = self.guild_queues.get(guild_id)
+        if guild_queue is None:
             return
-        self.queue_open = True
-        self.active_testers.add(interaction.user.id)
-        await self.update_queue_message()
-        await interaction.response.send_message('Queue opened!', ephemeral=True)
+        if setting == 'ticket_category':
+            await guild_queue.tickets.restart()
+        elif setting.startswith(('queue_channel', 'queue_max')):
+            for shard in guild_queue.shards.values():
+                if setting.startswith('queue_channel') and shard.message and shard.message.channel.id != shard.channel_id:
+                    shard.message = None
+                shard.refresher.mark_dirty()
+
+    @app_commands.command(name='start', description='Open the queue for people to join')
+    @app_commands.describe(region='Region you are testing; leave empty to take players from any region')
+    @app_commands.choices(region=REGION_CHOICES)
+    @tester_only()
+    async def start(self, interaction: Interaction, region: str = None):
+        guild_queue = self.queue_for(interaction.guild_id)
+        async def job():
+            tester_id = interaction.user.id
+            where = f'the {region} queue' if region else 'all queues'
+            async with guild_queue.lock:
+                if tester_id in guild_queue.active_testers and guild_queue.active_testers[tester_id] == region:
+                    return 'You are already an active tester.'
+                guild_queue.add_tester(tester_id, region)
+                if guild_queue.queue_open:
+                    await guild_queue.update_queue_message()
+                    return f'You are now an active tester for {where}. Use /next to pull the next person in the queue.'
+                guild_queue.queue_open = True
+                await guild_queue.update_queue_message()
+            return f'Queue opened! You are testing {where}.'
+        await self.pipeline.submit(interaction, job)
 
     @app_commands.command(name='leave', description='Leave the queue')
     async def leave(self, interaction: Interaction):
-        user_id = interaction.user.id
-        if user_id in self.queue:
-            self.queue.remove(user_id)
-            await self.update_queue_message()
-            await interaction.response.send_message('You have left the queue.', ephemeral=True)
-        else:
-            await interaction.response.send_message('You are not in the queue.', ephemeral=True)
+        guild_queue = self.queue_for(interaction.guild_id)
+        async def job():
+            user_id = interaction.user.id
+            async with guild_queue.lock:
+                shard = guild_queue.shard_of(user_id)
+                if not shard:
+                    return 'You are not in the queue.'
+                guild_queue.dequeue(shard, user_id)
+                await guild_queue.update_queue_message()
+            return 'You have left the queue.'
+        await self.pipeline.submit(interaction, job)
 
     @app_commands.command(name='stop', description='Close the queue (Tester only)')
-    @app_commands.checks.has_role(TESTER_ROLE_ID)
+    @tester_only()
     async def stop(self, interaction: Interaction):
-        if not self.queue_open:
-            await interaction.response.send_message('Queue is already closed.', ephemeral=True)
-            return
-        self.active_testers.discard(interaction.user.id)
-        if not self.active_testers:
-            self.queue_open = False
-            self.queue.clear()
-            await self.close_ticket()
-            await self.update_queue_message()
-            await interaction.response.send_message('Queue closed and cleared (no more active testers).', ephemeral=True)
-        else:
-            await self.update_queue_message()
-            await interaction.response.send_message('You are no longer an active tester. Queue remains open for others.', ephemeral=True)
+        guild_queue = self.queue_for(interaction.guild_id)
+        async def job():
+            async with guild_queue.lock:
+                if not guild_queue.queue_open:
+                    return 'Queue is already closed.'
+                guild_queue.remove_tester(interaction.user.id)
+                if guild_queue.active_testers:
+                    session = guild_queue.end_session(interaction.user.id)
+                    message = 'You are no longer an active tester. Queue remains open for others.'
+                    # The testee was already taken off the queue; they go back
+                    # to the front rather than losing their place untested.
+                    if session and session.testee_id and not guild_queue.shard_of(session.testee_id):
+                        user_info = await queuedb.get_user_info(guild_queue.guild_id, session.testee_id)
+                        guild_queue.requeue(guild_queue.shard_for(user_info['region'] if user_info else None), session.testee_id)
+                        message += f' <@{session.testee_id}> is back at the front of the queue.'
+                    await guild_queue.update_queue_message()
+                    tickets = [session.ticket_channel_id] if session else []
+                else:
+                    guild_queue.queue_open = False
+                    for shard in guild_queue.shards.values():
+                        for user_id in shard.queue:
+                            guild_queue.changes.leave(user_id)
+                        shard.queue.clear()
+                    tickets = [session.ticket_channel_id for session in guild_queue.sessions.values()]
+                    for tester_id in guild_queue.sessions:
+                        guild_queue.changes.end_session(tester_id)
+                    guild_queue.sessions.clear()
+                    await guild_queue.update_queue_message()
+                    await guild_queue.save_snapshot()
+                    message = 'Queue closed and cleared (no more active testers).'
+            for ticket_channel_id in tickets:
+                await self.close_ticket(guild_queue, ticket_channel_id)
+            return message
+        await self.pipeline.submit(interaction, job)
 
     @app_commands.command(name='next', description='Move to next in queue and open a ticket')
     @app_commands.describe(tier='Tier for the previous testee')
-    @app_commands.checks.has_role(TESTER_ROLE_ID)
+    @tester_only()
     async def next(self, interaction: Interaction, tier: str):
         await self.assign_tier_and_advance(interaction, tier, advance=True)
 
     @app_commands.command(name='skip', description='Skip current testee')
-    @app_commands.checks.has_role(TESTER_ROLE_ID)
+    @tester_only()
     async def skip(self, interaction: Interaction):
-        await self.close_ticket()
-        await self.advance_queue(interaction)
-        await interaction.response.send_message('Skipped to next in queue.', ephemeral=True)
+        guild_queue = self.queue_for(interaction.guild_id)
+        async def job():
+            async with guild_queue.lock:
+                session = guild_queue.sessions.get(interaction.user.id)
+                ticket_channel_id = session.ticket_channel_id if session else None
+                next_testee = guild_queue.advance_session(interaction.user.id)
+                await guild_queue.update_queue_message()
+            await self.close_ticket(guild_queue, ticket_channel_id)
+            if next_testee:
+                await self.open_ticket(guild_queue, interaction.user, next_testee)
+                return 'Skipped to next in queue.'
+            return 'Skipped. The queue is empty.'
+        await self.pipeline.submit(interaction, job)
 
     @app_commands.command(name='close', description='Close ticket and assign tier')
     @app_commands.describe(tier='Tier for the testee')
-    @app_commands.checks.has_role(TESTER_ROLE_ID)
+    @tester_only()
     async def close(self, interaction: Interaction, tier: str):
         await self.assign_tier_and_advance(interaction, tier, advance=False)
 
     @app_commands.command(name='queue', description='Show the current queue')
-    async def queue_cmd(self, interaction: Interaction):
-        embed = discord.Embed(
-            title=f"Aurora Queue ({len(self.queue)}/{QUEUE_MAX})",
-            color=discord.Color.blue()
-        )
-        if self.queue:
-            embed.add_field(
-                name="Queue",
-                value="\n".join([f"{i+1}. <@{user_id}>" for i, user_id in enumerate(self.queue)]),
-                inline=False
-            )
-        else:
-            embed.add_field(name="Queue", value="No one in queue.", inline=False)
-        if self.active_testers:
-            tester_mentions = [f"<@{tid}>" for tid in self.active_testers]
-            embed.add_field(name="Active Testers", value=", ".join(tester_mentions), inline=False)
+    @app_commands.describe(region='Which regional queue to show; defaults to the one you are in')
+    @app_commands.choices(region=REGION_CHOICES)
+    async def queue_cmd(self, interaction: Interaction, region: str = None):
+        guild_queue = self.queue_for(interaction.guild_id)
+        if region:
+            shard = guild_queue.shards[region]
         else:
-            embed.add_field(name="Active Testers", value="None", inline=False)
-        embed.set_footer(text="Use /leave to leave the queue.")
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+            shard = guild_queue.shard_of(interaction.user.id) or guild_queue.shards[QUEUE_REGIONS[0]]
+        if shard.page_count() == 1:
+            await interaction.response.send_message(embed=shard.embed(0), ephemeral=True)
+            return
+        await interaction.response.send_message(embed=shard.embed(0), view=QueuePageView(shard), ephemeral=True)
+
+    @app_commands.command(name='position', description='Show your position in the queue')
+    async def position(self, interaction: Interaction):
+        await self.handle_position(interaction)
 
-    @app_commands.command(name='ticket', description='Show the current ticket channel (Tester only)')
-    @app_commands.checks.has_role(TESTER_ROLE_ID)
+    @app_commands.command(name='ticket', description='Show your current ticket channel (Tester only)')
+    @tester_only()
     async def ticket(self, interaction: Interaction):
-        if self.current_ticket:
-            await interaction.response.send_message(f'Current ticket: {self.current_ticket.mention}', ephemeral=True)
+        session = self.queue_for(interaction.guild_id).sessions.get(interaction.user.id)
+        if session and session.ticket_channel_id:
+            await interaction.response.send_message(f'Current ticket: <#{session.ticket_channel_id}>', ephemeral=True)
         else:
             await interaction.response.send_message('No ticket is currently open.', ephemeral=True)
 
-    async def handle_join_queue(self, interaction: Interaction):
-        user_id = interaction.user.id
-        user_info = await queuedb.get_user_info(user_id)
-        now = int(time.time())
-        if user_info and user_info.get('last_test_timestamp'):
-            last = user_info['last_test_timestamp']
-            if last and now - last < TEST_INTERVAL_DAYS * 86400:
-                remaining = (last + TEST_INTERVAL_DAYS * 86400 - now) // 86400 + 1
-                await interaction.response.send_message(f"You must wait {remaining} more day(s) before you can be tested again.", ephemeral=True)
-                return
-        if not self.queue_open:
-            await interaction.response.send_message('Queue is not open.', ephemeral=True)
-            return
-        if user_id in self.queue:
-            await interaction.response.send_message('You are already in the queue.', ephemeral=True)
-            return
-        if len(self.queue) >= QUEUE_MAX:
-            await interaction.response.send_message('Queue is full.', ephemeral=True)
+    async def handle_position(self, interaction: Interaction):
+        shard = self.queue_for(interaction.guild_id).shard_of(interaction.user.id)
+        if shard is None:
+            await interaction.response.send_message('You are not in the queue.', ephemeral=True)
             return
-        self.queue.append(user_id)
-        await self.update_queue_message()
-        await interaction.response.send_message('You have joined the queue.', ephemeral=True)
+        position = shard.queue.position(interaction.user.id)
+        await interaction.response.send_message(f'You are #{position} of {len(shard.queue)} in the {shard.region} queue.', ephemeral=True)
+
+    async def handle_join_queue(self, interaction: Interaction):
+        guild_queue = self.queue_for(interaction.guild_id)
+        async def job():
+            user_id = interaction.user.id
+            remaining = self.cooldowns.remaining((guild_queue.guild_id, user_id))
+            if remaining:
+                return f"You must wait {int(remaining) // 86400 + 1} more day(s) before you can be tested again."
+            user_info = await queuedb.get_user_info(guild_queue.guild_id, user_id)
+            shard = guild_queue.shard_for(user_info['region'] if user_info else None)
+            async with guild_queue.lock:
+                if not guild_queue.queue_open:
+                    return 'Queue is not open.'
+                if guild_queue.shard_of(user_id):
+                    return 'You are already in the queue.'
+                if guild_queue.testing(user_id):
+                    return 'You are already being tested.'
+                if len(shard.queue) >= shard.max_size:
+                    return f'The {shard.region} queue is full.'
+                guild_queue.enqueue(shard, user_id)
+                await guild_queue.update_queue_message()
+            return f'You have joined the {shard.region} queue.'
+        await self.pipeline.submit(interaction, job)
 
     async def assign_tier_and_advance(self, interaction, tier, advance=True):
         if tier not in TIERS:
             await interaction.response.send_message(f'Invalid tier. Valid tiers: {", ".join(TIERS)}', ephemeral=True)
             return
-        previous_tier = self.previous_tier if self.current_testee == getattr(self, 'last_testee', None) else None
-        tester = interaction.user
-        testee_id = self.current_testee
-        if testee_id:
-            channel = self.bot.get_channel(TIER_ANNOUNCE_CHANNEL_ID)
-            if channel:
-                embed = discord.Embed(
-                    title="Test Result",
-                    color=discord.Color.green()
-                )
-                embed.add_field(name="Tester", value=tester.mention, inline=True)
-                embed.add_field(name="Testee", value=f"<@{testee_id}>", inline=True)
-                embed.add_field(name="Previous Tier", value=previous_tier if previous_tier else "N/A", inline=True)
-                embed.add_field(name="Achieved Tier", value=tier, inline=True)
-                await channel.send(content=f'<@{testee_id}>', embed=embed)
-            member = interaction.guild.get_member(testee_id)
-            if member:
-                for t, rid in TIER_ROLE_IDS.items():
-                    if rid and discord.utils.get(member.roles, id=rid):
-                        await member.remove_roles(discord.Object(id=rid), reason="Tier updated")
-                role_id = TIER_ROLE_IDS.get(tier)
-                if role_id:
-                    await member.add_roles(discord.Object(id=role_id), reason=f"Assigned tier {tier}")
-                waitlist_role = interaction.guild.get_role(WAITLIST_ROLE_ID)
-                if waitlist_role and waitlist_role in member.roles:
-                    await member.remove_roles(waitlist_role, reason="Completed test")
-            await queuedb.set_last_test_timestamp(testee_id, int(time.time()))
-        self.previous_tier = tier
-        self.last_testee = testee_id
-        await self.update_queue_message()
-        await self.close_ticket()
-        if advance:
-            await self.advance_queue(interaction)
-            await interaction.response.send_message(f'Tier {tier} assigned. Advanced to next.', ephemeral=True)
-        else:
-            await interaction.response.send_message(f'Tier {tier} assigned. Ticket closed.', ephemeral=True)
+        guild_queue = self.queue_for(interaction.guild_id)
+        guild_id = guild_queue.guild_id
+        async def job():
+            tester = interaction.user
+            async with guild_queue.lock:
+                session = guild_queue.sessions.get(tester.id)
+                testee_id = session.testee_id if session else None
+                if not testee_id and not advance:
+                    return 'You are not testing anyone right now.'
+                ticket_channel_id = session.ticket_channel_id if session else None
+                previous_tier = None
+                if testee_id:
+                    previous_tier = await queuedb.get_current_tier(guild_id, testee_id)
+                    user_info = await queuedb.get_user_info(guild_id, testee_id)
+                    region = guild_queue.shard_for(user_info['region'] if user_info else None).region
+                    tested_at = int(time.time())
+                    cooldown_until = tested_at + guild_queue.config.test_interval
+                    guild_queue.changes.add_result(tester.id, testee_id, tier, TIERS.index(tier), region, tested_at, cooldown_until)
+                    self.cooldowns.schedule((guild_id, testee_id), cooldown_until)
+                if advance:
+                    next_testee = guild_queue.advance_session(tester.id)
+                else:
+                    next_testee = None
+                    guild_queue.end_session(tester.id)
+                await guild_queue.update_queue_message()
+            await self.close_ticket(guild_queue, ticket_channel_id)
+            if next_testee:
+                await self.open_ticket(guild_queue, tester, next_testee)
+            if not testee_id:
+                return 'Advanced to next.' if next_testee else 'The queue is empty.'
+            announced, roles = self.announce_result(guild_queue, interaction.guild, tester, testee_id, previous_tier, tier)
+            # The result is committed and the session has moved on, so the
+            # reply goes out now. A failed announcement or role edit is
+            # reported after it; an error reply would invite a retry that
+            # gives the tier to the next testee.
+            await self.pipeline.reply(interaction, f'Tier {tier} assigned. Advanced to next.' if advance else f'Tier {tier} assigned. Ticket closed.')
+            task = asyncio.create_task(self.report_result(interaction, testee_id, tier, announced, roles))
+            self.reporters.add(task)
+            task.add_done_callback(self.reporters.discard)
+        await self.pipeline.submit(interaction, job)
 
-    async def advance_queue(self, interaction):
-        if self.queue:
-            self.current_testee = self.queue.pop(0)
-            await self.update_queue_message()
-            await self.open_ticket(interaction.user, self.current_testee)
-        else:
-            self.current_testee = None
-            await self.update_queue_message()
+    def announce_result(self, guild_queue, guild, tester, testee_id, previous_tier, tier):
+        # Returns the futures of the announcement and the role edit, or None
+        # for either when there is nothing to do.
+        announced = roles = None
+        channel = self.bot.get_channel(guild_queue.config.announce_channel_id)
+        if channel:
+            embed = discord.Embed(
+                title="Test Result",
+                color=discord.Color.green()
+            )
+            embed.add_field(name="Tester", value=tester.mention, inline=True)
+            embed.add_field(name="Testee", value=f"<@{testee_id}>", inline=True)
+            embed.add_field(name="Previous Tier", value=previous_tier if previous_tier else "N/A", inline=True)
+            embed.add_field(name="Achieved Tier", value=tier, inline=True)
+            announced = dispatcher.submit(lambda: channel.send(content=f'<@{testee_id}>', embed=embed), NORMAL, ('announce', channel.id))
+        member = guild.get_member(testee_id)
+        if member:
+            tier_role_ids = guild_queue.config.tier_role_ids()
+            roles = reconciler.reconcile(
+                member,
+                add={tier_role_ids[tier]},
+                remove=set(tier_role_ids.values()) | {guild_queue.config.waitlist_role_id},
+                reason=f"Assigned tier {tier}"
+            )
+        return announced, roles
+
+    async def report_result(self, interaction, testee_id, tier, announced, roles):
+        problems = []
+        for future, problem in ((announced, 'the result could not be announced'), (roles, 'their roles could not be updated')):
+            if future is None:
+                continue
+            try:
+                await future
+            except Exception as e:
+                print(f'Failed to finish the tier {tier} result for {testee_id}: {e}')
+                problems.append(problem)
+        if problems:
+            await self.pipeline.reply(interaction, f'Tier {tier} was recorded for <@{testee_id}>, but {" and ".join(problems)}. Please fix this by hand.')
 
-    async def open_ticket(self, tester, testee_id):
+    async def lift_cooldowns(self, expired):
+        await self.bot.wait_until_ready()
+        edits = []
+        dms = []
+        for (guild_id, user_id), _ in expired:
+            guild = self.bot.get_guild(guild_id)
+            member = guild.get_member(user_id) if guild else None
+            if not member:
+                continue
+            waitlist_role_id = guild_configs.get(guild_id).waitlist_role_id
+            if waitlist_role_id:
+                edits.append(reconciler.reconcile(member, add={waitlist_role_id}, reason="Test cooldown ended"))
+            if COOLDOWN_DM:
+                dms.append(dispatcher.submit(lambda member=member: member.send('Your test cooldown has ended, you can join the queue again.'), LOW, ('dm', guild_id)))
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f'Failed to restore waitlist role: {result}')
+        await asyncio.gather(*dms, return_exceptions=True)
+        await queuedb.clear_cooldowns([(guild_id, user_id, until) for (guild_id, user_id), until in expired])
+
+    async def open_ticket(self, guild_queue, tester, testee_id):
         guild = tester.guild
-        user_info = await queuedb.get_user_info(testee_id)
+        user_info = await queuedb.get_user_info(guild.id, testee_id)
         ign = user_info['ign'] if user_info and 'ign' in user_info else f"user{testee_id}"
         ticket_name = f"{ign.lower()}-{tester.name.lower()}"
         overwrites = {
             guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            tester: discord.PermissionOverwrite(view_channel=True),
-            guild.get_member(testee_id): discord.PermissionOverwrite(view_channel=True)
+            tester: discord.PermissionOverwrite(view_channel=True)
         }
-        ticket_channel = await guild.create_text_channel(ticket_name, overwrites=overwrites)
-        self.current_ticket = ticket_channel
-        previous_tier = self.previous_tier if testee_id == getattr(self, 'last_testee', None) else None
+        testee = guild.get_member(testee_id)
+        if testee:
+            overwrites[testee] = discord.PermissionOverwrite(view_channel=True)
+        ticket_channel = await guild_queue.tickets.claim(guild, ticket_name, overwrites)
+        async with guild_queue.lock:
+            # The tester may have moved on while the channel was being created.
+            session = guild_queue.sessions.get(tester.id)
+            stale = not session or session.testee_id != testee_id
+            if not stale:
+                session.ticket_channel_id = ticket_channel.id
+                guild_queue.save_session(session)
+                await guild_queue.persist()
+        if stale:
+            guild_queue.tickets.release(ticket_channel)
+            return
+        previous_tier = await queuedb.get_current_tier(guild.id, testee_id)
         embed = discord.Embed(
             title=f"Test Session for {ign}",
             color=discord.Color.purple()
         )
         embed.add_field(name="IGN", value=ign, inline=True)
         embed.add_field(name="Last Tier", value=previous_tier if previous_tier else "N/A", inline=True)
-        await ticket_channel.send(embed=embed)
-        await ticket_channel.send(f"Test session for <@{testee_id}> with {tester.mention}")
+        route = ('ticket_message', ticket_channel.id)
+        await dispatcher.submit(lambda: ticket_channel.send(embed=embed), NORMAL, route)
+        await dispatcher.submit(lambda: ticket_channel.send(f"Test session for <@{testee_id}> with {tester.mention}"), NORMAL, route)
 
-    async def close_ticket(self):
-        if self.current_ticket:
-            await self.current_ticket.delete()
-            self.current_ticket = None
+    async def close_ticket(self, guild_queue, ticket_channel_id):
+        if not ticket_channel_id:
+            return
+        channel = self.bot.get_channel(ticket_channel_id)
+        if channel:
+            guild_queue.tickets.release(channel)
 
 async def setup(bot):
-    cog = QueueCog(bot)
-    await bot.add_cog(cog)
-    await cog.cog_load()
+    await bot.add_cog(QueueCog(bot))
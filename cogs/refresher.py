@@ -0,0 +1,54 @@
+import asyncio
+import discord
+from .dispatch import BacklogFull
+
+class EmbedRefresher:
+    # Coalesces bursts of mark_dirty() calls into at most one refresh per
+    # interval. The refresh renders whatever the state is when it runs, and a
+    # change that lands during a refresh schedules another one, so the last
+    # edit always shows the latest state.
+    def __init__(self, refresh, interval):
+        self.refresh = refresh
+        self.interval = interval
+        self.dirty = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def mark_dirty(self):
+        self.dirty.set()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.dirty.is_set():
+            self.dirty.clear()
+            await self.refresh()
+
+    async def run(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            delay = self.interval
+            try:
+                await self.refresh()
+            except discord.HTTPException as e:
+                print(f'Failed to refresh queue message: {e}')
+                self.dirty.set()
+                if e.status == 429:
+                    delay = max(delay, getattr(e, 'retry_after', 0) or 5)
+            except BacklogFull as e:
+                # The edit was evicted or refused by the dispatcher; it is
+                # retried like a failed request.
+                print(f'Failed to refresh queue message: {e}')
+                self.dirty.set()
+            except Exception as e:
+                print(f'Failed to refresh queue message: {e}')
+            await asyncio.sleep(delay)
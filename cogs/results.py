@@ -0,0 +1,116 @@
+import discord
+from discord.ext import commands
+from discord import app_commands, Interaction, ui
+import os
+from dotenv import load_dotenv
+from . import db as queuedb
+from .queue import TIERS, REGION_CHOICES
+
+load_dotenv()
+RESULTS_PAGE_SIZE = int(os.getenv('RESULTS_PAGE_SIZE', 10))
+
+class ResultsPageView(ui.View):
+    # Previous/Next over a query-backed list. render(page, after) returns the
+    # embed and the key of the page's last row, which is where the next page
+    # starts; keys of pages already shown are kept for going back.
+    def __init__(self, render, page_count, keys):
+        super().__init__(timeout=300)
+        self.render = render
+        self.page_count = page_count
+        self.page = 0
+        self.keys = keys
+
+    async def show(self, interaction, page):
+        self.page = max(0, min(page, self.page_count - 1, len(self.keys) - 1))
+        embed, last_key = await self.render(self.page, self.keys[self.page])
+        if last_key is not None and self.page + 1 == len(self.keys):
+            self.keys.append(last_key)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @ui.button(label='Previous', style=discord.ButtonStyle.gray)
+    async def previous_page(self, interaction: Interaction, button: ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @ui.button(label='Next', style=discord.ButtonStyle.gray)
+    async def next_page(self, interaction: Interaction, button: ui.Button):
+        await self.show(interaction, self.page + 1)
+
+def page_count(total):
+    return max(1, (total + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE)
+
+class ResultsCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def cog_load(self):
+        await queuedb.open_db(self)
+
+    async def cog_unload(self):
+        await queuedb.close_db(self)
+
+    async def send_pages(self, interaction, render, total):
+        pages = page_count(total)
+        embed, last_key = await render(0, None)
+        if pages == 1:
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        await interaction.response.send_message(embed=embed, view=ResultsPageView(render, pages, [None, last_key]), ephemeral=True)
+
+    @app_commands.command(name='history', description='Show the test history of a player')
+    @app_commands.describe(user='Whose history to show; defaults to you')
+    async def history(self, interaction: Interaction, user: discord.Member = None):
+        user = user or interaction.user
+        total = await queuedb.count_user_results(interaction.guild_id, user.id)
+        async def render(page, after):
+            results = await queuedb.get_user_results(interaction.guild_id, user.id, after, RESULTS_PAGE_SIZE)
+            embed = discord.Embed(title=f'Test History for {user.display_name}', color=discord.Color.blue())
+            if results:
+                embed.description = '\n'.join(
+                    f"**{r['tier']}** ({r['region']}) by <@{r['tester_id']}> <t:{r['tested_at']}:R>" for r in results
+                )
+            else:
+                embed.description = 'No tests recorded.'
+            embed.set_footer(text=f'Page {page + 1}/{page_count(total)} • {total} test(s)')
+            return embed, results[-1]['key'] if results else None
+        await self.send_pages(interaction, render, total)
+
+    @app_commands.command(name='leaderboard', description='Show players by their current tier')
+    @app_commands.describe(region='Only show players from this region')
+    @app_commands.choices(region=REGION_CHOICES)
+    async def leaderboard(self, interaction: Interaction, region: str = None):
+        counts = await queuedb.get_tier_counts(interaction.guild_id)
+        by_tier = {}
+        for (tier, tier_region), count in counts.items():
+            if not region or tier_region == region:
+                by_tier[tier] = by_tier.get(tier, 0) + count
+        total = sum(by_tier.values())
+        summary = ' • '.join(f'{tier}: {by_tier[tier]}' for tier in reversed(TIERS) if by_tier.get(tier))
+        async def render(page, after):
+            offset = page * RESULTS_PAGE_SIZE
+            rows = await queuedb.get_leaderboard(interaction.guild_id, region, after, RESULTS_PAGE_SIZE)
+            embed = discord.Embed(title=f"Aurora {region + ' ' if region else ''}Leaderboard", color=discord.Color.gold())
+            if rows:
+                embed.description = '\n'.join(
+                    f"{offset + i + 1}. <@{r['user_id']}> **{r['tier']}** ({r['region']})" for i, r in enumerate(rows)
+                )
+            else:
+                embed.description = 'No players ranked yet.'
+            if summary:
+                embed.add_field(name='Players per Tier', value=summary, inline=False)
+            embed.set_footer(text=f'Page {page + 1}/{page_count(total)} • {total} player(s)')
+            return embed, rows[-1]['key'] if rows else None
+        await self.send_pages(interaction, render, total)
+
+    @app_commands.command(name='testerstats', description='Show how many tests a tester has run')
+    @app_commands.describe(tester='Whose stats to show; defaults to you')
+    async def testerstats(self, interaction: Interaction, tester: discord.Member = None):
+        tester = tester or interaction.user
+        stats = await queuedb.get_tester_stats(interaction.guild_id, tester.id)
+        embed = discord.Embed(title=f'Tester Stats for {tester.display_name}', color=discord.Color.blue())
+        embed.add_field(name='Total Tests', value=str(stats['total']), inline=False)
+        breakdown = '\n'.join(f"{tier}: {stats['by_tier'][tier]}" for tier in reversed(TIERS) if stats['by_tier'].get(tier))
+        embed.add_field(name='By Tier', value=breakdown or 'N/A', inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(ResultsCog(bot))
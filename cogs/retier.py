@@ -0,0 +1,85 @@
+import asyncio
+import os
+import time
+from . import db as queuedb
+from .roles import reconciler
+from .dispatch import LOW
+
+RETIER_PAGE_SIZE = int(os.getenv('RETIER_PAGE_SIZE', 500))
+RETIER_CONCURRENCY = int(os.getenv('RETIER_CONCURRENCY', 25))
+
+class RetierJob:
+    # Re-applies tier roles to every member of a guild from their latest
+    # result. Members are walked a page at a time from the member cache with
+    # one player_tiers query per page, and only members whose tier roles are
+    # wrong are reconciled, at most RETIER_CONCURRENCY at once and at low
+    # priority so tests running meanwhile are not held up. Members with no
+    # stored result are left alone: results were not kept before, so their
+    # tier roles are the only record of their tier.
+    def __init__(self, guild, tier_role_ids, page_size=RETIER_PAGE_SIZE, concurrency=RETIER_CONCURRENCY):
+        self.guild = guild
+        self.tier_role_ids = {tier: role_id for tier, role_id in tier_role_ids.items() if role_id}
+        self.page_size = max(1, page_size)
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.total = 0
+        self.scanned = 0
+        self.changed = 0
+        self.untested = 0
+        self.failed = 0
+        self.last_error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def done(self):
+        return self.task is not None and self.task.done()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def cancel(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        members = [member for member in self.guild.members if not member.bot]
+        self.total = len(members)
+        tier_roles = set(self.tier_role_ids.values())
+        try:
+            for start in range(0, len(members), self.page_size):
+                page = members[start:start + self.page_size]
+                tiers = await queuedb.get_current_tiers(self.guild.id, [member.id for member in page])
+                edits = []
+                for member in page:
+                    self.scanned += 1
+                    if member.id not in tiers:
+                        self.untested += 1
+                        continue
+                    role_id = self.tier_role_ids.get(tiers[member.id])
+                    target = {role_id} if role_id else set()
+                    if {role.id for role in member.roles} & tier_roles != target:
+                        await self.semaphore.acquire()
+                        edits.append(asyncio.create_task(self.apply(member, target, tier_roles - target)))
+                await asyncio.gather(*edits)
+        finally:
+            self.finished_at = time.time()
+
+    async def apply(self, member, add, remove):
+        try:
+            if await reconciler.reconcile(member, add=add, remove=remove, reason='Re-tier', priority=LOW):
+                self.changed += 1
+        except Exception as e:
+            self.failed += 1
+            self.last_error = e
+        finally:
+            self.semaphore.release()
+
+    def progress(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        status = 'Finished' if self.finished_at else 'Running'
+        text = f'{status}: {self.scanned}/{self.total} members checked, {self.changed} updated, {self.untested} without a result, {self.failed} failed ({elapsed:.0f}s)'
+        if self.last_error:
+            text += f'\nLast error: {self.last_error}'
+        return text
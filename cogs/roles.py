@@ -0,0 +1,81 @@
+import asyncio
+import os
+import discord
+from .dispatch import dispatcher, NORMAL, LOW
+
+ROLE_BATCH_SECONDS = float(os.getenv('ROLE_BATCH_SECONDS', 0.5))
+ROLE_EDIT_CONCURRENCY = int(os.getenv('ROLE_EDIT_CONCURRENCY', 4))
+
+class PendingRoles:
+    def __init__(self, member):
+        self.member = member
+        self.add = set()
+        self.remove = set()
+        self.reasons = []
+        self.waiters = []
+        self.priority = LOW
+
+class RoleReconciler:
+    # Turns "add these, remove those" into a single member edit with the full
+    # target role list. Requests for the same member within ROLE_BATCH_SECONDS
+    # are merged, members are edited with bounded concurrency per guild through
+    # the API dispatcher, and nothing is
+    # sent when a member already has exactly the target roles.
+    def __init__(self, batch_seconds=ROLE_BATCH_SECONDS, concurrency=ROLE_EDIT_CONCURRENCY):
+        self.batch_seconds = batch_seconds
+        dispatcher.set_limit('member_edit', concurrency)
+        self.pending = {}
+        self.flusher = None
+
+    def reconcile(self, member, add=(), remove=(), reason=None, priority=NORMAL):
+        # Returns a future resolving to True if an edit was made. Merged
+        # requests are sent at the most urgent of their priorities.
+        add = {rid for rid in add if rid}
+        remove = {rid for rid in remove if rid} - add
+        key = (member.guild.id, member.id)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = PendingRoles(member)
+        # Later requests win over earlier ones for the same role.
+        entry.add = (entry.add - remove) | add
+        entry.remove = (entry.remove - add) | remove
+        entry.member = member
+        entry.priority = min(entry.priority, priority)
+        if reason and reason not in entry.reasons:
+            entry.reasons.append(reason)
+        future = asyncio.get_running_loop().create_future()
+        entry.waiters.append(future)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush_later())
+        return future
+
+    async def flush_later(self):
+        # Requests made while a batch is being applied go in the next batch.
+        while self.pending:
+            await asyncio.sleep(self.batch_seconds)
+            await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        await asyncio.gather(*(self.apply(entry) for entry in batch.values()))
+
+    async def apply(self, entry):
+        member = entry.member
+        current = {role.id for role in member.roles if role.id != member.guild.id}
+        target = (current - entry.remove) | entry.add
+        try:
+            changed = target != current
+            if changed:
+                roles = [discord.Object(id=rid) for rid in target]
+                reason = '; '.join(entry.reasons) or None
+                await dispatcher.submit(lambda: member.edit(roles=roles, reason=reason), entry.priority, ('member_edit', member.guild.id))
+        except Exception as e:
+            for future in entry.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in entry.waiters:
+            if not future.done():
+                future.set_result(changed)
+
+reconciler = RoleReconciler()
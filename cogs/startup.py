@@ -0,0 +1,16 @@
+import time
+from contextlib import contextmanager
+
+STARTED_AT = time.perf_counter()
+
+@contextmanager
+def phase(name):
+    # Logs how long one step of startup took, whether or not it succeeded.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        print(f'Startup: {name} took {(time.perf_counter() - start) * 1000:.0f}ms')
+
+def since_start():
+    return time.perf_counter() - STARTED_AT
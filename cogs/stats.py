@@ -0,0 +1,105 @@
+import discord
+from discord.ext import commands
+from discord import app_commands, Interaction
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from . import db as queuedb
+from .metrics import metrics, since_created
+
+load_dotenv()
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.prom')
+METRICS_SECONDS = float(os.getenv('METRICS_SECONDS', 15))
+STATS_TOP = 8
+
+class RateLimitCounter(logging.Handler):
+    # discord.py waits out 429s itself and only logs them, so its warnings
+    # are where rate limit hits can be counted.
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith('We are being rate limited'):
+            metrics.count('rate_limit_hits', 'route')
+        elif message.startswith('Global rate limit has been hit'):
+            metrics.count('rate_limit_hits', 'global')
+
+class StatsCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.request = None
+        self.handler = RateLimitCounter()
+        self.writer = None
+
+    async def cog_load(self):
+        self.instrument_http()
+        logging.getLogger('discord.http').addHandler(self.handler)
+        if METRICS_FILE and (self.writer is None or self.writer.done()):
+            self.writer = asyncio.create_task(self.write_metrics())
+
+    async def cog_unload(self):
+        if self.writer:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+            self.writer = None
+            self.write_file()
+        logging.getLogger('discord.http').removeHandler(self.handler)
+        if self.request:
+            self.bot.http.request = self.request
+            self.request = None
+
+    def instrument_http(self):
+        # Every REST call discord.py makes goes through HTTPClient.request, so
+        # timing it there covers edits, channel creates, role changes and the
+        # rest, labelled by route template rather than by channel or user.
+        if self.request:
+            return
+        self.request = request = self.bot.http.request
+        async def timed_request(route, **kwargs):
+            with metrics.timer('discord', f'{route.method} {route.path}'):
+                try:
+                    return await request(route, **kwargs)
+                except discord.HTTPException as e:
+                    metrics.count('discord_errors', str(e.status))
+                    raise
+        self.bot.http.request = timed_request
+
+    async def write_metrics(self):
+        while True:
+            await asyncio.sleep(METRICS_SECONDS)
+            self.write_file()
+
+    def write_file(self):
+        # Written to a temporary file and renamed, so a scraper never reads half of it.
+        path = f'{METRICS_FILE}.tmp'
+        try:
+            with open(path, 'w') as f:
+                f.write(metrics.render())
+            os.replace(path, METRICS_FILE)
+        except OSError as e:
+            print(f'Failed to write metrics: {e}')
+
+    @commands.Cog.listener()
+    async def on_app_command_completion(self, interaction: Interaction, command):
+        # Commands run through the pipeline are timed when their followup is sent.
+        if not interaction.extras.get('pipelined'):
+            metrics.observe('command', command.qualified_name, since_created(interaction))
+
+    @app_commands.command(name='stats', description='(Admin) Show command, database and Discord API timings')
+    @app_commands.checks.has_permissions(administrator=True)
+    async def stats(self, interaction: Interaction):
+        embed = discord.Embed(title='Aurora Stats', color=discord.Color.blue())
+        for kind, title in (('command', 'Commands'), ('db', 'Database'), ('discord', 'Discord API'), ('dispatch', 'Dispatch Queue Wait')):
+            histograms = sorted(metrics.of_kind(kind).items(), key=lambda item: -item[1].sum)[:STATS_TOP]
+            lines = [
+                f'`{label}` {h.count}× p50 {h.percentile(50) * 1000:.0f}ms p99 {h.percentile(99) * 1000:.0f}ms'
+                for label, h in histograms
+            ]
+            embed.add_field(name=f'{title} (by total time)', value='\n'.join(lines)[:1024] or 'None yet', inline=False)
+        counters = [f'{name}{f" ({label})" if label else ""}: {value}' for (name, label), value in sorted(metrics.counters.items())]
+        embed.add_field(name='Counters', value='\n'.join(counters)[:1024] or 'None', inline=False)
+        cache = queuedb.user_cache.stats()
+        embed.add_field(name='User Cache', value=f"{cache['size']} rows, {cache['hit_rate']:.0%} hit rate", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(StatsCog(bot))
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import time
+from collections import deque
+import discord
+from dotenv import load_dotenv
+from . import db as queuedb
+from .dispatch import dispatcher, BacklogFull, CRITICAL, LOW
+
+load_dotenv()
+TICKET_POOL_SIZE = int(os.getenv('TICKET_POOL_SIZE', 3))
+TICKET_POOL_REFILL_SECONDS = float(os.getenv('TICKET_POOL_REFILL_SECONDS', 10))
+POOL_CHANNEL_NAME = 'ticket-pool'
+# Discord allows this many name changes per channel per window.
+RENAME_LIMIT = 2
+RENAME_WINDOW_SECONDS = 600
+# A bulk delete takes at most 100 messages. A channel with more than
+# PURGE_MAX_CHUNKS of them is deleted rather than emptied.
+PURGE_CHUNK_SIZE = 100
+PURGE_MAX_CHUNKS = int(os.getenv('TICKET_PURGE_MAX_CHUNKS', 5))
+
+class TicketPool:
+    # Keeps hidden ticket channels pre-created in a guild's ticket category, so
+    # opening a ticket is one channel edit instead of a create and closing one
+    # is a purge instead of a delete. Pool channels are known by the ids
+    # stored in ticket_channels rather than by name: a closed ticket keeps its
+    # name and only its overwrites are reset, so each ticket costs one rename.
+    # A channel renamed RENAME_LIMIT times in the last RENAME_WINDOW_SECONDS
+    # is passed over, and a claim with no renameable channel creates one
+    # instead of waiting out Discord's rate limit. The pool is refilled in the
+    # background at most one channel per TICKET_POOL_REFILL_SECONDS. Without a
+    # category it falls back to creating and deleting channels.
+    def __init__(self, bot, config, size=TICKET_POOL_SIZE, refill_seconds=TICKET_POOL_REFILL_SECONDS):
+        self.bot = bot
+        self.config = config
+        self.size = size
+        self.refill_seconds = refill_seconds
+        self.idle = deque()
+        self.renamed_at = {}
+        self.wake = asyncio.Event()
+        self.task = None
+        self.recycling = set()
+
+    @property
+    def guild_id(self):
+        return self.config.guild_id
+
+    @property
+    def category_id(self):
+        return self.config.ticket_category_id
+
+    @property
+    def enabled(self):
+        return bool(self.category_id and self.size > 0)
+
+    def category(self):
+        return self.bot.get_channel(self.category_id) if self.category_id else None
+
+    def start(self):
+        if self.enabled and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await asyncio.gather(*self.recycling, return_exceptions=True)
+
+    async def restart(self):
+        # The category changed; channels idling in the old one are left alone.
+        await self.stop()
+        self.idle.clear()
+        self.start()
+
+    def hidden_overwrites(self, guild):
+        return {
+            guild.default_role: discord.PermissionOverwrite(view_channel=False),
+            guild.me: discord.PermissionOverwrite(view_channel=True, manage_channels=True, manage_messages=True)
+        }
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        category = self.category()
+        if not category:
+            print(f'Ticket category {self.category_id} not found; ticket pool disabled.')
+            return
+        # Channels left idle by a previous run are reused; ones that are gone
+        # or in another category are forgotten. Channels still named
+        # ticket-pool are from before ids were stored.
+        stored = await queuedb.load_ticket_channels(self.guild_id)
+        for channel_id, (idle, renamed_at) in stored.items():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or channel.category_id != category.id:
+                await queuedb.delete_ticket_channel(channel_id)
+                continue
+            self.renamed_at[channel_id] = renamed_at
+            if idle and channel_id not in self.idle:
+                self.idle.append(channel_id)
+        for channel in category.text_channels:
+            if channel.name == POOL_CHANNEL_NAME and channel.id not in stored and channel.id not in self.idle:
+                await self.add_idle(channel)
+        while len(self.idle) < self.size:
+            if not await self.create(category):
+                break
+        while True:
+            # Channels being recycled will come back to the pool, so they count.
+            # Waiting before a refill gives tickets that are about to close the
+            # chance to be reused instead of creating a new channel.
+            if len(self.idle) + len(self.recycling) >= self.size:
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+            await asyncio.sleep(self.refill_seconds)
+            if len(self.idle) + len(self.recycling) < self.size:
+                await self.create(category)
+
+    async def add_idle(self, channel):
+        await queuedb.save_ticket_channel(self.guild_id, channel.id, True, self.renamed_at.setdefault(channel.id, []))
+        self.idle.append(channel.id)
+
+    async def forget(self, channel_id):
+        self.renamed_at.pop(channel_id, None)
+        await queuedb.delete_ticket_channel(channel_id)
+
+    async def create(self, category):
+        try:
+            channel = await dispatcher.submit(lambda: category.guild.create_text_channel(
+                POOL_CHANNEL_NAME,
+                category=category,
+                overwrites=self.hidden_overwrites(category.guild),
+                reason='Ticket pool refill'
+            ), LOW, ('ticket_refill', category.guild.id))
+        except (discord.HTTPException, BacklogFull) as e:
+            print(f'Failed to refill ticket pool: {e}')
+            return False
+        await self.add_idle(channel)
+        return True
+
+    def recent_renames(self, channel_id, now):
+        return [t for t in self.renamed_at.get(channel_id, []) if t > now - RENAME_WINDOW_SECONDS]
+
+    def take_idle(self, name, now):
+        # The first idle channel that already has the name or can still be
+        # renamed; the others stay queued in order.
+        for channel_id in self.idle:
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or channel.name == name or len(self.recent_renames(channel_id, now)) < RENAME_LIMIT:
+                self.idle.remove(channel_id)
+                return channel_id, channel
+        return None, None
+
+    async def claim(self, guild, name, overwrites):
+        while True:
+            now = time.time()
+            channel_id, channel = self.take_idle(name, now)
+            if channel_id is None:
+                break
+            if channel is None:
+                await self.forget(channel_id)
+                continue
+            self.wake.set()
+            renamed_at = self.recent_renames(channel_id, now)
+            if channel.name != name:
+                renamed_at.append(now)
+            self.renamed_at[channel_id] = renamed_at
+            try:
+                await dispatcher.submit(lambda: channel.edit(name=name, overwrites=overwrites, reason='Ticket opened'), CRITICAL, ('ticket', guild.id))
+            except discord.NotFound:
+                await self.forget(channel_id)
+                continue
+            await queuedb.save_ticket_channel(self.guild_id, channel_id, False, renamed_at)
+            return channel
+        self.wake.set()
+        category = self.category()
+        return await dispatcher.submit(lambda: guild.create_text_channel(name, overwrites=overwrites, category=category), CRITICAL, ('ticket', guild.id))
+
+    def release(self, channel):
+        # Returns immediately; the purge and reset happen in the background.
+        task = asyncio.create_task(self.recycle(channel))
+        self.recycling.add(task)
+        task.add_done_callback(self.recycled)
+
+    def recycled(self, task):
+        self.recycling.discard(task)
+        self.wake.set()
+
+    async def purge(self, channel, route):
+        # One bulk delete per dispatcher job, so a long ticket never holds a
+        # worker through all of them. False if the channel is still not empty.
+        for _ in range(PURGE_MAX_CHUNKS):
+            deleted = await dispatcher.submit(lambda: channel.purge(limit=PURGE_CHUNK_SIZE), LOW, route)
+            if len(deleted) < PURGE_CHUNK_SIZE:
+                return True
+        return False
+
+    async def recycle(self, channel):
+        # Keyed by channel so the clean-up never queues behind, or holds up,
+        # the CRITICAL claims and creates on ('ticket', guild).
+        route = ('ticket_recycle', channel.id)
+        if self.enabled and len(self.idle) < self.size and channel.category_id == self.category_id:
+            try:
+                if await self.purge(channel, route):
+                    await dispatcher.submit(lambda: channel.edit(overwrites=self.hidden_overwrites(channel.guild), reason='Ticket closed'), LOW, route)
+                    await self.add_idle(channel)
+                    return
+            except discord.NotFound:
+                await self.forget(channel.id)
+                return
+            except (discord.HTTPException, BacklogFull) as e:
+                # Half reset, it may still show the old ticket to both users.
+                print(f'Failed to recycle ticket channel {channel.id}, deleting it: {e}')
+        await self.forget(channel.id)
+        try:
+            await dispatcher.submit(lambda: channel.delete(), LOW, route)
+        except discord.NotFound:
+            pass
+        except (discord.HTTPException, BacklogFull) as e:
+            print(f'Failed to delete ticket channel {channel.id}: {e}')
@@ -0,0 +1,114 @@
+import csv
+import json
+import os
+from . import db as queuedb
+from .config import guild_configs, QUEUE_REGIONS, TIERS
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 1000))
+MAX_REPORTED_ERRORS = 5
+FORMATS = ('csv', 'jsonl')
+FIELDS = {
+    'users': ('user_id', 'ign', 'region', 'last_test_timestamp', 'cooldown_until'),
+    'results': ('testee_id', 'tester_id', 'tier', 'region', 'tested_at'),
+}
+
+def detect_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return {'csv': 'csv', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}.get(extension)
+
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+def text(row, field):
+    # None would otherwise become the string 'None'.
+    value = row[field]
+    value = str(value).strip() if value is not None else ''
+    if not value:
+        raise ValueError(f'{field} cannot be empty')
+    return value
+
+def region_of(row):
+    region = text(row, 'region').upper()
+    if region not in QUEUE_REGIONS:
+        raise ValueError(f'unknown region {region!r}')
+    return region
+
+def user_info_record(row):
+    ign = text(row, 'ign')
+    region = region_of(row)
+    return (int(row['user_id']), ign, region, optional_int(row.get('last_test_timestamp')), optional_int(row.get('cooldown_until')))
+
+def result_record(row):
+    tier = text(row, 'tier').upper()
+    if tier not in TIERS:
+        raise ValueError(f'unknown tier {tier!r}')
+    region = region_of(row)
+    return (int(row['testee_id']), int(row['tester_id']), tier, TIERS.index(tier), region, int(row['tested_at']))
+
+async def import_user_info(guild_id, rows):
+    return await queuedb.import_user_info(guild_id, rows, guild_configs.get(guild_id).test_interval)
+
+def jsonl_lines(f):
+    return (line for line in f if line.strip())
+
+def read_records(read, f, report):
+    # A file that cannot be read further (bad encoding, a CSV field over the
+    # csv module's size limit) ends the import with what was read so far.
+    try:
+        yield from read(f)
+    except (csv.Error, UnicodeDecodeError) as e:
+        report['errors'].append(f"stopped reading after record {report['read']}: {e}")
+
+# Format -> (records from a text file, one record -> dict). JSONL lines are
+# decoded per record so a bad line only skips that row.
+READERS = {
+    'csv': (csv.DictReader, dict),
+    'jsonl': (jsonl_lines, json.loads),
+}
+# Kind -> (row dict -> db tuple, batch writer, row stream).
+KINDS = {
+    'users': (user_info_record, import_user_info, queuedb.stream_user_info),
+    'results': (result_record, queuedb.import_results, queuedb.stream_results),
+}
+
+async def import_file(kind, guild_id, f, fmt, progress=None):
+    # Reads f a record at a time and writes every IMPORT_BATCH_SIZE valid rows
+    # as one executemany transaction, so memory stays flat and other writes
+    # get in between batches. progress is awaited with the report after each.
+    read, decode = READERS[fmt]
+    parse, save, _ = KINDS[kind]
+    report = {'read': 0, 'imported': 0, 'skipped': 0, 'errors': []}
+    batch = []
+    for number, raw in enumerate(read_records(read, f, report), 1):
+        report['read'] = number
+        try:
+            batch.append(parse(decode(raw)))
+        except (KeyError, TypeError, ValueError) as e:
+            report['skipped'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append(f'record {number}: missing {e}' if isinstance(e, KeyError) else f'record {number}: {e}')
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            report['imported'] += await save(guild_id, batch)
+            batch = []
+            if progress:
+                await progress(report)
+    if batch:
+        report['imported'] += await save(guild_id, batch)
+    return report
+
+async def export_file(kind, guild_id, f, fmt):
+    # Writes rows as they are paged out of the database; returns the count.
+    _, _, stream = KINDS[kind]
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, FIELDS[kind])
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: f.write(json.dumps(row) + '\n')
+    count = 0
+    async for row in stream(guild_id, EXPORT_PAGE_SIZE):
+        write(row)
+        count += 1
+    return count
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+MISSING = object()
+
+def ign_index(row):
+    return (row['guild_id'], row['ign_key']) if row and row['ign_key'] else None
+
+class UserInfoCache:
+    # LRU of user_info rows keyed by (guild_id, user_id), with a second index
+    # from (guild_id, normalized IGN) to that key. Unknown users are cached as
+    # None so repeated clicks from unverified users stay off the disk too.
+    # Writers go through update; a read that raced a write is not cached,
+    # which is what the `writes` counter passed to fill is for.
+    def __init__(self, size):
+        self.size = max(0, size)
+        self.rows = OrderedDict()
+        self.by_ign = {}
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        row = self.rows.get(key, MISSING)
+        if row is MISSING:
+            self.misses += 1
+            return MISSING
+        self.rows.move_to_end(key)
+        self.hits += 1
+        return row
+
+    def fill(self, key, row, writes):
+        if writes == self.writes:
+            self.store(key, row)
+
+    def update(self, key, **fields):
+        # Patches a cached row in place; anything else is dropped and will be
+        # read back from the database on the next lookup.
+        self.writes += 1
+        row = self.rows.get(key)
+        if row is not None:
+            self.unindex(key, row)
+            row.update(fields)
+            if ign_index(row):
+                self.by_ign[ign_index(row)] = key
+        else:
+            self.rows.pop(key, None)
+
+    def unindex(self, key, row):
+        index = ign_index(row)
+        if index and self.by_ign.get(index) == key:
+            del self.by_ign[index]
+
+    def store(self, key, row):
+        if not self.size:
+            return
+        self.unindex(key, self.rows.pop(key, None))
+        self.rows[key] = row
+        if ign_index(row):
+            self.by_ign[ign_index(row)] = key
+        while len(self.rows) > self.size:
+            self.unindex(*self.rows.popitem(last=False))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.rows),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
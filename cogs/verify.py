@@ -1,19 +1,16 @@
 import discord
 from discord.ext import commands
 from discord import app_commands, Interaction, ui
-import os
-from dotenv import load_dotenv
 from . import db as queuedb
+from .roles import reconciler
+from .config import guild_configs, QUEUE_REGIONS
+from .startup import phase
+from .metrics import metrics, since_created
+from .dispatch import dispatcher, BacklogFull, LOW
 import time
 
-load_dotenv()
-VERIFY_CHANNEL_ID = int(os.getenv('VERIFY_CHANNEL_ID', 0))
-QUEUE_ACCESS_ROLE_ID = int(os.getenv('QUEUE_ACCESS_ROLE_ID', 0))
-WAITLIST_ROLE_ID = int(os.getenv('WAITLIST_ROLE_ID', 0))
-TEST_INTERVAL_DAYS = int(os.getenv('TEST_INTERVAL_DAYS', 3))
-
 class VerifyModal(ui.Modal, title="Join Waitlist"):
-    region = ui.TextInput(label="Region (NA/EU)", placeholder="NA or EU", required=True, max_length=4)
+    region = ui.TextInput(label=f"Region ({'/'.join(QUEUE_REGIONS)})"[:45], placeholder=' or '.join(QUEUE_REGIONS)[:100], required=True, max_length=max(4, *map(len, QUEUE_REGIONS)) + 2)
     ign = ui.TextInput(label="IGN (In-Game Name)", placeholder="Your Minecraft IGN", required=True, max_length=32)
 
     def __init__(self, cog):
@@ -21,9 +18,15 @@ class VerifyModal(ui.Modal, title="Join Waitlist"):
         self.cog = cog
 
     async def on_submit(self, interaction: Interaction):
-        region = self.region.value.upper()
+        # The region picks the queue shard, so anything else is turned away
+        # rather than landing in the first region's queue.
+        region = self.region.value.strip().upper()
         ign = self.ign.value
+        if region not in QUEUE_REGIONS:
+            await interaction.response.send_message(f"Unknown region. Enter one of: {', '.join(QUEUE_REGIONS)}.", ephemeral=True)
+            return
         await self.cog.handle_verification(interaction, region, ign)
+        metrics.observe('command', 'verify', since_created(interaction))
 
 class VerifyView(ui.View):
     def __init__(self, cog):
@@ -37,52 +40,97 @@ class VerifyView(ui.View):
 class VerifyCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.view = None
+        self.messages = {}
+
+    async def cog_load(self):
+        await queuedb.open_db(self)
+        await dispatcher.open(self)
+        await guild_configs.load()
+        with phase('verify messages'):
+            self.messages = await queuedb.load_verify_messages()
+        if self.view is None:
+            self.view = VerifyView(self)
+            self.bot.add_view(self.view)
+
+    async def cog_unload(self):
+        await dispatcher.close(self)
+        await queuedb.close_db(self)
 
     @commands.Cog.listener()
     async def on_ready(self):
-        channel = self.bot.get_channel(VERIFY_CHANNEL_ID)
-        if channel:
-            async for msg in channel.history(limit=10):
-                if msg.author == self.bot.user:
-                    return
-            embed = discord.Embed(
-                title="Welcome to the Aurora Waitlist!",
-                description="Click the button below and fill out the form to access the queue.",
-                color=discord.Color.gold()
-            )
-            await channel.send(embed=embed, view=VerifyView(self))
+        for guild in self.bot.guilds:
+            channel = self.bot.get_channel(guild_configs.get(guild.id).verify_channel_id)
+            if channel:
+                await self.ensure_verify_embed(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_config_update(self, guild_id, setting):
+        if setting == 'verify_channel':
+            channel = self.bot.get_channel(guild_configs.get(guild_id).verify_channel_id)
+            if channel:
+                await self.ensure_verify_embed(channel)
+
+    async def ensure_verify_embed(self, channel):
+        # The posted message is remembered, so this is one fetch rather than a
+        # history scan, and a deleted embed is posted again. The scan only runs
+        # for a channel with nothing stored, to pick up an embed posted before
+        # its id was saved.
+        stored = self.messages.get(channel.guild.id)
+        if stored and stored[0] == channel.id:
+            try:
+                await dispatcher.submit(lambda: channel.fetch_message(stored[1]), LOW, ('verify_embed', channel.id))
+            except discord.NotFound:
+                await self.post_verify_embed(channel)
+            except (discord.HTTPException, BacklogFull) as e:
+                print(f'Failed to check the verify embed in {channel.id}: {e}')
+            return
+        async for msg in channel.history(limit=10):
+            if msg.author == self.bot.user:
+                await self.remember(channel, msg)
+                return
+        await self.post_verify_embed(channel)
+
+    async def post_verify_embed(self, channel):
+        embed = discord.Embed(
+            title="Welcome to the Aurora Waitlist!",
+            description="Click the button below and fill out the form to access the queue.",
+            color=discord.Color.gold()
+        )
+        view = self.view
+        await self.remember(channel, await dispatcher.submit(lambda: channel.send(embed=embed, view=view), LOW, ('verify_embed', channel.id)))
+
+    async def remember(self, channel, message):
+        self.messages[channel.guild.id] = (channel.id, message.id)
+        await queuedb.save_verify_message(channel.guild.id, channel.id, message.id)
 
     async def handle_verification(self, interaction: Interaction, region, ign):
-        user_info = await queuedb.get_user_info_by_ign(ign)
+        config = guild_configs.get(interaction.guild_id)
         now = int(time.time())
-        if user_info and user_info.get('last_test_timestamp'):
-            last = user_info['last_test_timestamp']
-            if last and now - last < TEST_INTERVAL_DAYS * 86400:
-                remaining = (last + TEST_INTERVAL_DAYS * 86400 - now) // 86400 + 1
-                await interaction.response.send_message(f"You are on cooldown. You must wait {remaining} more day(s) before verifying again.", ephemeral=True)
-                return
-        queue_role = interaction.guild.get_role(QUEUE_ACCESS_ROLE_ID) if 'QUEUE_ACCESS_ROLE_ID' in globals() else None
-        waitlist_role = interaction.guild.get_role(WAITLIST_ROLE_ID)
-        if queue_role:
-            await interaction.user.add_roles(queue_role, reason="Verified for queue access")
-        if waitlist_role:
-            await interaction.user.add_roles(waitlist_role, reason="Verified for waitlist")
-        await queuedb.save_user_info(interaction.user.id, ign, region)
+        last = await queuedb.verify_user_info(interaction.guild_id, interaction.user.id, ign, region, now - config.test_interval)
+        if last:
+            remaining = (last + config.test_interval - now) // 86400 + 1
+            await interaction.response.send_message(f"You are on cooldown. You must wait {remaining} more day(s) before verifying again.", ephemeral=True)
+            return
+        role_ids = {role_id for role_id in (config.queue_access_role_id, config.waitlist_role_id) if interaction.guild.get_role(role_id)}
+        # Role edits are batched and queued, which can take longer than the
+        # 3 seconds Discord gives the first response, so it goes out first.
+        roles = reconciler.reconcile(interaction.user, add=role_ids, reason="Verified for queue access")
         await interaction.response.send_message(f"You have been verified and given access to the queue! Region: {region}, IGN: {ign}", ephemeral=True)
+        try:
+            await roles
+        except Exception as e:
+            print(f'Failed to give verify roles to {interaction.user.id}: {e}')
+            await interaction.followup.send("Your details were saved, but the queue roles could not be given. Please ask a staff member.", ephemeral=True)
 
     @app_commands.command(name="verifyembed", description="(Admin) Post the verify embed in the verify channel.")
     @app_commands.checks.has_permissions(administrator=True)
     async def verifyembed(self, interaction: Interaction):
-        channel = self.bot.get_channel(VERIFY_CHANNEL_ID)
+        channel = self.bot.get_channel(guild_configs.get(interaction.guild_id).verify_channel_id)
         if not channel:
             await interaction.response.send_message("Verify channel not found.", ephemeral=True)
             return
-        embed = discord.Embed(
-            title="Welcome to the Aurora Waitlist!",
-            description="Click the button below and fill out the form to access the queue.",
-            color=discord.Color.gold()
-        )
-        await channel.send(embed=embed, view=VerifyView(self))
+        await self.post_verify_embed(channel)
         await interaction.response.send_message("Verify embed posted!", ephemeral=True)
 
 async def setup(bot):
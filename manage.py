@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import sys
+from contextlib import nullcontext
+from cogs import db as queuedb
+from cogs.config import guild_configs
+from cogs.transfer import import_file, export_file, detect_format, FORMATS, FIELDS
+
+# Runs against queuebot.db directly. The bot keeps user info and tier counts
+# cached, so stop it before importing or it will not see the changes until
+# it restarts.
+
+def resolve_format(args):
+    fmt = args.format or (detect_format(args.path) if args.path != '-' else 'csv')
+    if fmt is None:
+        sys.exit(f'Cannot tell the format of {args.path}; pass --format')
+    return fmt
+
+async def print_progress(report):
+    print(f"{report['read']} record(s) read, {report['imported']} imported, {report['skipped']} skipped", file=sys.stderr)
+
+async def run_import(args):
+    fmt = resolve_format(args)
+    with (open(args.path, encoding='utf-8-sig', newline='') if args.path != '-' else nullcontext(sys.stdin)) as f:
+        report = await import_file(args.kind, args.guild_id, f, fmt, print_progress)
+    await print_progress(report)
+    for error in report['errors']:
+        print(error, file=sys.stderr)
+
+async def run_export(args):
+    fmt = resolve_format(args)
+    with (open(args.path, 'w', encoding='utf-8', newline='') if args.path != '-' else nullcontext(sys.stdout)) as f:
+        count = await export_file(args.kind, args.guild_id, f, fmt)
+    print(f'Exported {count} row(s)', file=sys.stderr)
+
+async def run(args):
+    await queuedb.open_db()
+    try:
+        await queuedb.init_db()
+        await guild_configs.load()
+        await args.handler(args)
+    finally:
+        await queuedb.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python manage.py', description='Bulk import and export of user info and test results.')
+    commands = parser.add_subparsers(required=True, metavar='command')
+    for name, handler, help in (('import', run_import, 'Load rows from a file into the database'), ('export', run_export, 'Write rows from the database to a file')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('kind', choices=list(FIELDS), help='users: ' + ', '.join(FIELDS['users']) + '; results: ' + ', '.join(FIELDS['results']))
+        command.add_argument('guild_id', type=int)
+        command.add_argument('path', nargs='?', default='-', help='File to read or write, - for stdin/stdout (the default)')
+        command.add_argument('--format', choices=FORMATS, help='Defaults to the file extension, or csv for stdin/stdout')
+        command.set_defaults(handler=handler)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()